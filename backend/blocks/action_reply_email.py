@@ -5,72 +5,39 @@ FEATURES:
 - Custom instructions override default prompt
 - Draft mode: creates draft instead of auto-sending (REPLACES old drafts)
 - Smart reply decision (filters automated emails)
+- Fast mode (replyMode="combined"): decision + reply in one AI call
+- Speculative mode (speculativeReply): reply generated while the decision runs,
+  recorded on the conversation thread once drafted or sent
 - Per-sender conversation memory
 """
-import os
+import asyncio
 import hashlib
 import re
-from supabase import create_client
 from dotenv import load_dotenv
 from services.backboard_service import backboard_service
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
+from services.conversation_threads import conversation_threads
+from services.gmail_service import get_user_gmail_service_async
+from services.gmail_draft_index import gmail_drafts
+from services.mailbox_identity import parse_address
+from services import email_prefilter
+from services.sender_reputation import sender_reputation
+from services.speculation_budget import speculation_budget, MIN_REPLY_RATE as SPECULATIVE_MIN_REPLY_RATE
+from googleapiclient.errors import HttpError
 import base64
 from email.mime.text import MIMEText
 
 load_dotenv()
 
-supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_KEY")
-)
-
 def strip_memory_annotations(text: str) -> str:
     text = re.sub(r"\[Memory\s*\d+\]", "", text)
     text = re.sub(r"\s{2,}", " ", text)
     return text.strip()
 
 
-def get_user_gmail_service(user_id: str):
-    result = supabase.table("user_oauth_credentials")\
-        .select("*")\
-        .eq("user_id", user_id)\
-        .eq("provider", "gmail")\
-        .single()\
-        .execute()
-    
-    if not result.data:
-        raise Exception(f"No Gmail credentials found for user {user_id}")
-    
-    creds_data = result.data
-    
-    creds = Credentials(
-        token=creds_data['access_token'],
-        refresh_token=creds_data['refresh_token'],
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.getenv("GOOGLE_CLIENT_ID"),
-        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-        scopes=['https://www.googleapis.com/auth/gmail.readonly', 
-                'https://www.googleapis.com/auth/gmail.send',
-                'https://www.googleapis.com/auth/gmail.modify']
-    )
-    
-    if creds.expired and creds.refresh_token:
-        from google.auth.transport.requests import Request
-        creds.refresh(Request())
-        
-        supabase.table("user_oauth_credentials").update({
-            "access_token": creds.token,
-            "token_expiry": creds.expiry.isoformat() if creds.expiry else None
-        }).eq("user_id", user_id).eq("provider", "gmail").execute()
-    
-    return build('gmail', 'v1', credentials=creds)
-
-
-def get_user_outlook_service(user_id: str):
+async def get_user_outlook_service(user_id: str):
     """Get Outlook service for user"""
     from services.outlook_service import get_outlook_service
-    return get_outlook_service(user_id)
+    return await get_outlook_service(user_id)
 
 
 def generate_conversation_key(gmail_thread_id: str, sender: str = None, subject: str = None) -> str:
@@ -92,85 +59,158 @@ async def get_or_create_backboard_thread(
     user_id: str,
     sender_email: str
 ) -> str:
-    result = supabase.table("email_conversations")\
-        .select("backboard_thread_id")\
-        .eq("conversation_key", conversation_key)\
-        .execute()
-    
-    if result.data and len(result.data) > 0:
-        print(f"Using existing Backboard thread: {result.data[0]['backboard_thread_id']}")
-        return result.data[0]["backboard_thread_id"]
-    
-    print(f"Creating new Backboard thread for conversation: {conversation_key}")
-    thread_id = await backboard_service.create_thread()
-    
-    supabase.table("email_conversations").insert({
-        "conversation_key": conversation_key,
-        "backboard_thread_id": thread_id,
-        "workspace_id": workspace_id,
-        "user_id": user_id,
-        "sender_email": sender_email
-    }).execute()
+    return await conversation_threads.get_or_create(
+        workspace_id=workspace_id,
+        conversation_key=conversation_key,
+        user_id=user_id,
+        sender_email=sender_email
+    )
+
+
+async def generate_reply(
+    conversation_key: str,
+    workspace_id: str,
+    user_id: str,
+    sender_email: str,
+    subject: str,
+    message_content: str
+) -> tuple[str, str]:
+    """Thread lookup + reply generation, returns (backboard_thread_id, ai_reply)"""
+    backboard_thread_id = await get_or_create_backboard_thread(
+        conversation_key=conversation_key,
+        workspace_id=workspace_id,
+        user_id=user_id,
+        sender_email=sender_email
+    )
     
-    return thread_id
+    ai_reply = await backboard_service.add_message_and_get_reply(
+        thread_id=backboard_thread_id,
+        sender_email=sender_email,
+        subject=subject,
+        body=message_content
+    )
+    return backboard_thread_id, ai_reply
+
+
+async def generate_speculative_reply(
+    conversation_key: str,
+    workspace_id: str,
+    user_id: str,
+    sender_email: str,
+    message_content: str
+) -> tuple[str, str]:
+    """
+    Thread lookup + reply drafted on a scratch thread with read-only memory
+    and the conversation's history, so a draft that gets discarded never
+    reaches the conversation thread or its memory.
+    Returns (backboard_thread_id, ai_reply).
+    """
+    backboard_thread_id = await get_or_create_backboard_thread(
+        conversation_key=conversation_key,
+        workspace_id=workspace_id,
+        user_id=user_id,
+        sender_email=sender_email
+    )
+    ai_reply = await backboard_service.complete_with_history(backboard_thread_id, message_content)
+    return backboard_thread_id, ai_reply
+
+
+async def record_speculative_reply(backboard_thread_id: str, message_content: str, ai_reply: str, label: str):
+    """A kept speculative reply joins the conversation thread once it was drafted or sent"""
+    try:
+        await backboard_service.record_exchange(backboard_thread_id, message_content, ai_reply, label)
+    except Exception as e:
+        print(f"Could not record reply on conversation thread: {e}")
+
+
+def discard_task(task: asyncio.Task):
+    """Cancel a speculative task without leaving an unretrieved exception behind"""
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
 
 
-def create_draft(user_id: str, to_email: str, subject: str, body: str, thread_id: str = None, provider: str = "gmail", email_id: str = None):
+async def create_draft(user_id: str, to_email: str, subject: str, body: str, thread_id: str = None, provider: str = "gmail", email_id: str = None):
     """Create draft - works with BOTH Gmail and Outlook"""
     
     if provider == "outlook":
         print(f"Creating Outlook draft...")
-        service = get_user_outlook_service(user_id)
+        service = await get_user_outlook_service(user_id)
         if thread_id:
-            service.delete_drafts_in_conversation(thread_id)
-        result = service.create_draft_reply(email_id, body)
+            result = await service.replace_draft_reply(thread_id, email_id, body)
+        else:
+            result = await service.create_draft_reply(email_id, body)
         print(f"Outlook draft created: {result['id']}")
         return result
     
     else:  # Gmail
         print(f"Creating Gmail draft...")
-        service = get_user_gmail_service(user_id)
-        
-        if thread_id:
-            print(f"Checking for existing Gmail drafts...")
-            try:
-                drafts_response = service.users().drafts().list(userId='me').execute()
-                if 'drafts' in drafts_response:
-                    for draft_item in drafts_response['drafts']:
-                        try:
-                            draft_detail = service.users().drafts().get(userId='me', id=draft_item['id']).execute()
-                            if draft_detail.get('message', {}).get('threadId') == thread_id:
-                                service.users().drafts().delete(userId='me', id=draft_item['id']).execute()
-                        except:
-                            pass
-            except:
-                pass
+        service = await get_user_gmail_service_async(user_id)
         
         message = MIMEText(body)
         message['to'] = to_email
         message['subject'] = f"Re: {subject}" if not subject.startswith("Re:") else subject
         raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
         draft_body = {'message': {'raw': raw_message}}
-        if thread_id:
-            draft_body['message']['threadId'] = thread_id
+        
+        if not thread_id:
+            result = service.users().drafts().create(userId='me', body=draft_body).execute()
+            print(f"Gmail draft created: {result['id']}")
+            return result
+        
+        draft_body['message']['threadId'] = thread_id
+        
+        # Replace our previous draft in this thread directly
+        draft_id = gmail_drafts.get(user_id, thread_id)
+        if draft_id:
+            try:
+                result = service.users().drafts().update(userId='me', id=draft_id, body=draft_body).execute()
+                print(f"Gmail draft replaced: {result['id']}")
+                return result
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                # Sent or deleted by the user in the meantime
+                gmail_drafts.forget(user_id, thread_id)
+        else:
+            print(f"Checking for existing Gmail drafts...")
+            try:
+                for old_draft_id in find_thread_drafts(service, thread_id, to_email):
+                    service.users().drafts().delete(userId='me', id=old_draft_id).execute()
+            except HttpError as e:
+                print(f"Could not clean up old drafts: {e}")
+        
         result = service.users().drafts().create(userId='me', body=draft_body).execute()
+        gmail_drafts.put(user_id, thread_id, result['id'])
         print(f"Gmail draft created: {result['id']}")
         return result
 
 
-def send_email(user_id: str, to_email: str, subject: str, body: str, thread_id: str = None, provider: str = "gmail", email_id: str = None):
+def find_thread_drafts(service, thread_id: str, to_email: str) -> list:
+    """
+    Index-miss fallback: one drafts.list narrowed to the recipient.
+    drafts.list already carries each draft's threadId, so no per-draft get is needed.
+    """
+    recipient = parse_address(to_email) or to_email
+    response = service.users().drafts().list(userId='me', q=f"to:{recipient}").execute()
+    return [
+        draft['id'] for draft in response.get('drafts', [])
+        if draft.get('message', {}).get('threadId') == thread_id
+    ]
+
+
+async def send_email(user_id: str, to_email: str, subject: str, body: str, thread_id: str = None, provider: str = "gmail", email_id: str = None):
     """Send email - works with BOTH Gmail and Outlook"""
     
     if provider == "outlook":
         print(f"Sending Outlook email...")
-        service = get_user_outlook_service(user_id)
-        result = service.send_reply(email_id, body)
+        service = await get_user_outlook_service(user_id)
+        result = await service.send_reply(email_id, body)
         print(f"Outlook email sent")
         return result
     
     else:
         print(f"Sending Gmail email...")
-        service = get_user_gmail_service(user_id)
+        service = await get_user_gmail_service_async(user_id)
         message = MIMEText(body)
         message['to'] = to_email
         message['subject'] = f"Re: {subject}" if not subject.startswith("Re:") else subject
@@ -210,24 +250,25 @@ async def execute_reply_email(
             subject=subject
         )
         
-        should_reply, decision_reason = await backboard_service.should_reply_to_email(
-            sender_email=sender_email,
-            subject=subject,
-            body=body
+        # Obvious automated mail is decided locally, without an LLM call
+        prefilter_reason = email_prefilter.classify(
+            sender=sender_email,
+            headers=trigger_data.get("headers"),
+            label_ids=trigger_data.get("label_ids")
         )
+        if prefilter_reason:
+            print(f"Pre-filter decision: {prefilter_reason}")
+            return {"status": "skipped", "reason": prefilter_reason, "to": sender_email}
         
-        if not should_reply:
-            return {"status": "skipped", "reason": decision_reason, "to": sender_email}
-        
-        backboard_thread_id = await get_or_create_backboard_thread(
-            conversation_key=conversation_key,
-            workspace_id=workspace_id,
-            user_id=user_id,
-            sender_email=sender_email
-        )
+        # Senders we keep saying NO to are skipped from memory
+        reputation_reason = sender_reputation.should_skip(workspace_id, sender_email)
+        if reputation_reason:
+            print(f"Reputation decision: {reputation_reason}")
+            return {"status": "skipped", "reason": reputation_reason, "to": sender_email}
         
         custom_instructions = config.get("customInstructions", "").strip()
         draft_mode = config.get("draftMode", True)
+        reply_mode = config.get("replyMode", "standard")
         
         if custom_instructions:
             message_content = f"""!!!CRITICAL INSTRUCTIONS - ABSOLUTE PRIORITY - MUST FOLLOW EXACTLY!!!
@@ -245,12 +286,66 @@ Now respond to this customer email:
         else:
             message_content = body.strip()
         
-        ai_reply = await backboard_service.add_message_and_get_reply(
-            thread_id=backboard_thread_id,
-            sender_email=sender_email,
-            subject=subject,
-            body=message_content
-        )
+        speculated = False
+        if reply_mode == "combined":
+            # One structured call on the conversation thread decides AND drafts
+            backboard_thread_id = await get_or_create_backboard_thread(
+                conversation_key=conversation_key,
+                workspace_id=workspace_id,
+                user_id=user_id,
+                sender_email=sender_email
+            )
+            
+            decision = await backboard_service.decide_and_reply(
+                thread_id=backboard_thread_id,
+                sender_email=sender_email,
+                subject=subject,
+                body=message_content
+            )
+            sender_reputation.record(workspace_id, sender_email, decision.should_reply)
+            
+            if not decision.should_reply:
+                return {"status": "skipped", "reason": decision.reason, "to": sender_email}
+            
+            ai_reply = decision.reply
+        else:
+            # Speculatively draft the reply on a scratch thread while the decision runs
+            reply_task = None
+            if config.get("speculativeReply", False):
+                reply_rate = sender_reputation.reply_rate(workspace_id, sender_email)
+                if reply_rate is not None and reply_rate >= SPECULATIVE_MIN_REPLY_RATE \
+                        and speculation_budget.try_spend(workspace_id):
+                    print(f"Speculating reply (sender reply rate {reply_rate:.0%})")
+                    reply_task = asyncio.create_task(generate_speculative_reply(
+                        conversation_key, workspace_id, user_id, sender_email, message_content
+                    ))
+            
+            try:
+                should_reply, decision_reason = await backboard_service.should_reply_to_email(
+                    sender_email=sender_email,
+                    subject=subject,
+                    body=body
+                )
+            except Exception:
+                if reply_task:
+                    discard_task(reply_task)
+                raise
+            sender_reputation.record(workspace_id, sender_email, should_reply)
+            
+            if not should_reply:
+                if reply_task:
+                    print(f"Discarding speculative reply")
+                    discard_task(reply_task)
+                return {"status": "skipped", "reason": decision_reason, "to": sender_email}
+            
+            if reply_task:
+                speculation_budget.refund(workspace_id)
+                backboard_thread_id, ai_reply = await reply_task
+                speculated = True
+            else:
+                backboard_thread_id, ai_reply = await generate_reply(
+                    conversation_key, workspace_id, user_id, sender_email, subject, message_content
+                )
         
         ai_reply = strip_memory_annotations(ai_reply)
         
@@ -287,7 +382,7 @@ Now respond to this customer email:
                         ai_reply += '\n' + expected_signature
         
         if draft_mode:
-            draft_result = create_draft(
+            draft_result = await create_draft(
                 user_id=user_id,
                 to_email=sender_email,
                 subject=subject,
@@ -296,6 +391,8 @@ Now respond to this customer email:
                 provider=provider,
                 email_id=email_id
             )
+            if speculated:
+                await record_speculative_reply(backboard_thread_id, message_content, ai_reply, "[Draft created]")
             return {
                 "status": "draft_created",
                 "draft_id": draft_result['id'],
@@ -306,7 +403,7 @@ Now respond to this customer email:
                 "reply_length": len(ai_reply)
             }
         else:
-            send_email(
+            await send_email(
                 user_id=user_id,
                 to_email=sender_email,
                 subject=subject,
@@ -315,6 +412,8 @@ Now respond to this customer email:
                 provider=provider,
                 email_id=email_id
             )
+            if speculated:
+                await record_speculative_reply(backboard_thread_id, message_content, ai_reply, "[Reply sent]")
             return {
                 "status": "success",
                 "reply_sent": True,
@@ -0,0 +1 @@
+# Lets `pytest backend/tests` import services.* when run from the repository root
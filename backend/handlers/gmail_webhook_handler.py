@@ -5,13 +5,21 @@ FIXED: Automatic token refresh handling
 import os
 import base64
 import json
-from datetime import datetime, timedelta
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
+import asyncio
+from datetime import datetime, timedelta, timezone
+from googleapiclient.errors import HttpError
 from google.cloud import pubsub_v1
 from supabase import create_client
 from dotenv import load_dotenv
+from services.gmail_service import get_user_gmail_service, get_user_gmail_service_async, execute_async, execute_isolated
+from services.mailbox_router import mailbox_router
+from services.cache_bus import cache_bus
+from services import email_jobs
+from services.dedupe_store import dedupe_store
+from services.leases import leases
+from services.mailbox_identity import mailbox_identities, is_self_sent
+from services.email_prefilter import relevant_headers
+from services.pipeline_plan import pipeline_plans
 
 load_dotenv()
 
@@ -24,74 +32,45 @@ supabase = create_client(
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT_ID")
 TOPIC_NAME = os.getenv("GMAIL_PUBSUB_TOPIC", "gmail-notifications")
 
+# Concurrency limits for processing messages of a history batch.
+# Per-user limit can be overridden with gmail_watches.max_concurrency.
+MAX_CONCURRENT_MESSAGES = int(os.getenv("GMAIL_MAX_CONCURRENT_MESSAGES", "16"))
+PER_USER_CONCURRENT_MESSAGES = int(os.getenv("GMAIL_PER_USER_CONCURRENT_MESSAGES", "4"))
+
+# Gmail batch endpoint accepts up to 100 sub-requests per call
+BATCH_SIZE = min(int(os.getenv("GMAIL_BATCH_SIZE", "50")), 100)
+BATCH_MAX_RETRIES = int(os.getenv("GMAIL_BATCH_MAX_RETRIES", "3"))
+RETRYABLE_STATUSES = {429, 500, 503}
+
+# Cluster-wide hold on a mailbox's history walk, renewed every page
+HISTORY_LEASE_SECONDS = int(os.getenv("GMAIL_HISTORY_LEASE_SECONDS", "300"))
+
+_global_slots = None
+_user_slots = {}
+# Mailboxes being walked in this process -> another notification arrived meanwhile
+_walks = {}
+
+
+def _global_semaphore() -> asyncio.Semaphore:
+    global _global_slots
+    if _global_slots is None:
+        _global_slots = asyncio.Semaphore(MAX_CONCURRENT_MESSAGES)
+    return _global_slots
 
-def get_user_gmail_service(user_id: str, force_refresh: bool = False):
-    """
-    Get Gmail service for specific user with automatic token refresh.
-    
-    Args:
-        user_id: User ID
-        force_refresh: If True, force token refresh even if not expired
-    """
-    result = supabase.table("user_oauth_credentials")\
-        .select("*")\
-        .eq("user_id", user_id)\
-        .eq("provider", "gmail")\
-        .single()\
-        .execute()
-    
-    if not result.data:
-        raise Exception(f"No Gmail credentials found for user {user_id}. Please reconnect Gmail.")
-    
-    creds_data = result.data
-    
-    # Check if refresh token exists
-    if not creds_data.get('refresh_token'):
-        raise Exception(f"No refresh token found for user {user_id}. User needs to re-authenticate with Gmail.")
-    
-    creds = Credentials(
-        token=creds_data['access_token'],
-        refresh_token=creds_data['refresh_token'],
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=os.getenv("GOOGLE_CLIENT_ID"),
-        client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
-        scopes=[
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.send',
-            'https://www.googleapis.com/auth/gmail.modify'
-        ]
-    )
-    
-    # Check if token is expired or force refresh
-    token_expired = False
-    if creds_data.get('token_expiry'):
-        try:
-            expiry = datetime.fromisoformat(creds_data['token_expiry'].replace('Z', '+00:00'))
-            token_expired = datetime.now(expiry.tzinfo) >= expiry
-        except:
-            token_expired = True
-    
-    if force_refresh or token_expired or creds.expired:
-        print(f"Refreshing expired token for user {user_id}...")
-        try:
-            creds.refresh(Request())
-            
-            # Update stored token
-            supabase.table("user_oauth_credentials").update({
-                "access_token": creds.token,
-                "token_expiry": creds.expiry.isoformat() if creds.expiry else None
-            }).eq("user_id", user_id).eq("provider", "gmail").execute()
-            
-            print(f"Token refreshed successfully for user {user_id}")
-        except Exception as refresh_error:
-            print(f"Token refresh failed: {refresh_error}")
-            raise Exception(
-                f"Failed to refresh Gmail token for user {user_id}. "
-                f"User needs to reconnect their Gmail account. "
-                f"Error: {str(refresh_error)}"
-            )
-    
-    return build('gmail', 'v1', credentials=creds)
+
+def _user_semaphore(user_id: str, limit: int) -> asyncio.Semaphore:
+    slots = _user_slots.get(user_id)
+    if slots is None or slots[0] != limit:
+        slots = _user_slots[user_id] = (limit, asyncio.Semaphore(limit))
+    return slots[1]
+
+
+def watch_request() -> dict:
+    """Watch request for Gmail push notifications"""
+    return {
+        'labelIds': ['INBOX'],  # Monitor inbox
+        'topicName': f'projects/{PROJECT_ID}/topics/{TOPIC_NAME}'
+    }
 
 
 def setup_gmail_watch(user_id: str, workspace_id: str):
@@ -116,34 +95,48 @@ def setup_gmail_watch(user_id: str, workspace_id: str):
                 )
             raise
         
-        # Watch request for Gmail push notifications
-        request = {
-            'labelIds': ['INBOX'],  # Monitor inbox
-            'topicName': f'projects/{PROJECT_ID}/topics/{TOPIC_NAME}'
-        }
-        
         print(f"Sending watch request to Gmail API...")
         
         # Start watching
-        response = service.users().watch(userId='me', body=request).execute()
+        response = service.users().watch(userId='me', body=watch_request()).execute()
         
         # Store watch details
-        expiration = datetime.fromtimestamp(int(response['expiration']) / 1000)
+        expiration = datetime.fromtimestamp(int(response['expiration']) / 1000, timezone.utc)
+        
+        # One Gmail watch serves every workspace on this mailbox; if other
+        # workspaces are already attached, keep their history cursor
+        existing = supabase.table("gmail_watches")\
+            .select("history_id")\
+            .eq("user_id", user_id)\
+            .execute()
+        history_id = min(
+            (w['history_id'] for w in existing.data or [] if w.get('history_id')),
+            key=int,
+            default=response['historyId']
+        )
         
         supabase.table("gmail_watches").upsert({
             "user_id": user_id,
             "workspace_id": workspace_id,
-            "history_id": response['historyId'],
+            "history_id": history_id,
             "expiration": expiration.isoformat()
-        }).execute()
+        }, on_conflict="user_id,workspace_id").execute()
+        
+        supabase.table("gmail_watches").update({
+            "expiration": expiration.isoformat()
+        }).eq("user_id", user_id).execute()
+        
+        profile = service.users().getProfile(userId='me').execute()
+        mailbox_router.add_gmail(profile['emailAddress'], user_id, workspace_id)
+        cache_bus.publish("gmail_watches", {"user_id": user_id, "workspace_id": workspace_id})
         
         print(f"   Gmail watch set up successfully for user {user_id}")
-        print(f"   History ID: {response['historyId']}")
+        print(f"   History ID: {history_id}")
         print(f"   Expires: {expiration}")
         
         return {
             "success": True,
-            "history_id": response['historyId'],
+            "history_id": history_id,
             "expiration": expiration.isoformat()
         }
         
@@ -155,14 +148,10 @@ def setup_gmail_watch(user_id: str, workspace_id: str):
 def stop_gmail_watch(user_id: str, workspace_id: str):
     """
     Stop Gmail push notifications for a user.
-    Called when workflow is stopped.
+    Called when workflow is stopped. The mailbox watch itself is only
+    stopped once no other workspace is attached to it.
     """
     try:
-        service = get_user_gmail_service(user_id)
-        
-        # Stop watching
-        service.users().stop(userId='me').execute()
-        
         # Remove from database
         supabase.table("gmail_watches")\
             .delete()\
@@ -170,6 +159,21 @@ def stop_gmail_watch(user_id: str, workspace_id: str):
             .eq("workspace_id", workspace_id)\
             .execute()
         
+        mailbox_router.remove_gmail(user_id, workspace_id)
+        cache_bus.publish("gmail_watches", {"user_id": user_id, "workspace_id": workspace_id})
+        
+        remaining = supabase.table("gmail_watches")\
+            .select("workspace_id")\
+            .eq("user_id", user_id)\
+            .execute()
+        if remaining.data:
+            print(f"Gmail watch kept for {len(remaining.data)} other workspace(s) of user {user_id}")
+            return {"success": True}
+        
+        # Stop watching
+        service = get_user_gmail_service(user_id)
+        service.users().stop(userId='me').execute()
+        
         print(f"Gmail watch stopped for user {user_id}")
         return {"success": True}
         
@@ -179,283 +183,566 @@ def stop_gmail_watch(user_id: str, workspace_id: str):
         return {"success": False, "error": str(e)}
 
 
-def renew_gmail_watch(user_id: str, workspace_id: str):
+def renew_gmail_watch(user_id: str, workspace_id: str = None):
     """
     Renew Gmail watch (should be called before expiration).
     Gmail watches expire after ~7 days.
+    Only the expiration of the mailbox's rows moves; the history cursor is
+    left alone so mail that arrived around the renewal is still walked.
+    Runs in an executor thread, so the call gets its own HTTP transport.
     """
-    return setup_gmail_watch(user_id, workspace_id)
+    service = get_user_gmail_service(user_id)
+    response = execute_isolated(user_id, service.users().watch(userId='me', body=watch_request()))
+    expiration = datetime.fromtimestamp(int(response['expiration']) / 1000, timezone.utc)
+    
+    supabase.table("gmail_watches").update({
+        "expiration": expiration.isoformat()
+    }).eq("user_id", user_id).execute()
+    
+    print(f"Gmail watch renewed for user {user_id}, expires {expiration}")
+    return {"success": True, "expiration": expiration.isoformat()}
+
 
+def _save_history_cursor(user_id: str, history_id: str):
+    supabase.table("gmail_watches").update({
+        "history_id": str(history_id)
+    }).eq("user_id", user_id).execute()
 
-async def process_gmail_notification(user_id: str, history_id: str):
+
+async def process_gmail_notification(user_id: str, history_id: str, raise_errors: bool = False):
     """
     Process a Gmail push notification.
     This is triggered when a new email arrives.
     
+    Streams every history page since the mailbox's stored cursor and moves
+    the cursor forward page by page, only after that page's messages have
+    been processed (inline) or enqueued (celery). A crash mid-burst resumes
+    from the last finished page; the dedupe store absorbs the overlap.
+    
     Args:
         user_id: User ID
         history_id: Gmail history ID from the notification
+        raise_errors: re-raise failures (Celery tasks, so their retries fire)
     """
+    # One walk per mailbox at a time. A notification arriving meanwhile
+    # doesn't wait (holding a work-queue slot); the running walk goes again
+    if user_id in _walks:
+        _walks[user_id] = True
+        return
+    
+    _walks[user_id] = False
     try:
-        # Get user's Gmail service
-        service = get_user_gmail_service(user_id)
-        
-        # Get stored history ID
-        watch_data = supabase.table("gmail_watches")\
-            .select("*")\
-            .eq("user_id", user_id)\
-            .single()\
-            .execute()
-        
-        if not watch_data.data:
-            print(f"No watch data found for user {user_id}")
-            return
-        
-        stored_history_id = watch_data.data['history_id']
-        workspace_id = watch_data.data['workspace_id']
-        
-        # Get history of changes since last check
-        history = service.users().history().list(
-            userId='me',
-            startHistoryId=stored_history_id,
-            historyTypes=['messageAdded']
-        ).execute()
-        
-        if 'history' not in history:
-            print(f"⏳ No new messages for user {user_id}")
-            return
-        
-        # Process new messages
-        new_messages = []
-        for record in history.get('history', []):
-            if 'messagesAdded' in record:
-                for msg_record in record['messagesAdded']:
-                    message = msg_record['message']
-                    new_messages.append(message['id'])
-        
-        print(f"Found {len(new_messages)} new messages for user {user_id}")
-        
-        # Update stored history ID
-        supabase.table("gmail_watches").update({
-            "history_id": history_id
-        }).eq("user_id", user_id).execute()
-        
-        # Process each new message (AWAIT each one!)
-        for message_id in new_messages:
-            await process_new_email(user_id, workspace_id, message_id)
-        
+        await _walk_until_settled(user_id, history_id)
     except Exception as e:
         print(f"Error processing Gmail notification: {e}")
         import traceback
         traceback.print_exc()
+        if raise_errors:
+            raise
+    finally:
+        del _walks[user_id]
 
 
-async def process_new_email(user_id: str, workspace_id: str, message_id: str):
+async def _walk_until_settled(user_id: str, history_id: str):
     """
-    Process a single new email - check conditions and trigger workflow.
-    This is the core logic that replaces check_for_emails polling.
+    Walk the mailbox's history, again for as long as notifications arrive
+    during a walk. With the shared tier (DEDUPE_REDIS_URL) the walk holds a
+    cluster-wide lease, and other nodes flag it instead of walking alongside.
     """
-    from blocks.action_reply_email import execute_reply_email
-    
-    try:
-        service = get_user_gmail_service(user_id)
-        
-        # Get full email details
-        email = service.users().messages().get(
-            userId='me',
-            id=message_id,
-            format='full'
-        ).execute()
-        
-        # Extract email data
-        headers = email['payload']['headers']
-        subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
-        from_email = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-        
-        # CRITICAL: Get the user's Gmail address to prevent infinite loops
-        profile = service.users().getProfile(userId='me').execute()
-        user_email = profile['emailAddress']
-        
-        # FILTER OUT emails sent by the user themselves (prevent catching own replies!)
-        if user_email.lower() in from_email.lower():
-            print(f"⏭Skipping email from self: {from_email}")
+    lease_name = f"gmail-history:{user_id}"
+    while True:
+        if leases.available and not leases.try_acquire(lease_name, HISTORY_LEASE_SECONDS, fail_open=True):
+            print(f"History of user {user_id} is being walked on another node, flagging a re-walk")
+            leases.set_flag(lease_name, HISTORY_LEASE_SECONDS)
             return
         
-        print(f"Processing email from {from_email}: {subject}")
-        
-        # Get email body
-        body = ""
-        if 'parts' in email['payload']:
-            for part in email['payload']['parts']:
-                if part['mimeType'] == 'text/plain' and 'data' in part.get('body', {}):
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                    break
-        elif 'body' in email['payload'] and 'data' in email['payload']['body']:
-            body = base64.urlsafe_b64decode(email['payload']['body']['data']).decode('utf-8')
-        
-        # Check if email has attachments
-        has_attachments = False
-        if 'parts' in email['payload']:
-            for part in email['payload']['parts']:
-                if part.get('filename'):  # Has a filename = attachment
-                    has_attachments = True
+        try:
+            while True:
+                _walks[user_id] = False
+                if not await _walk_history(user_id, history_id, lease_name):
+                    return
+                flagged = leases.take_flag(lease_name)
+                if not (_walks[user_id] or flagged):
                     break
+        finally:
+            leases.release(lease_name)
         
-        print(f"📎 Has attachments: {has_attachments}")
-        
-        # First, find the email-received condition block in pipeline_blocks
-        email_block = supabase.table("pipeline_blocks")\
-            .select("block_id, type")\
-            .eq("workspace_id", workspace_id)\
-            .eq("type", "condition-email-received")\
-            .execute()
-        
-        if not email_block.data or len(email_block.data) == 0:
-            print(f" No email-received block found in workspace {workspace_id}")
-            return
-        
-        block_id = email_block.data[0]['block_id']
-        print(f"Found email-received block: {block_id}")
-        
-        # Get the config for this block (if it exists)
-        config_result = supabase.table("block_configs")\
-            .select("config")\
-            .eq("workspace_id", workspace_id)\
-            .eq("block_id", block_id)\
-            .execute()
-        
-        # Use config if exists, otherwise empty filters (process all emails)
-        if config_result.data and len(config_result.data) > 0:
-            email_condition_config = config_result.data[0]['config']
-            print(f"Found email condition config: {email_condition_config}")
-        else:
-            email_condition_config = {}
-            print(f" No filters configured - processing all emails")
-        
-        # Check if email matches conditions
-        sender_filter = email_condition_config.get("senderEmail", "")
-        subject_filter = email_condition_config.get("subjectContains", "")
-        attachment_required = email_condition_config.get("hasAttachment", False)
-        
-        print(f" Checking filters:")
-        print(f"   Sender filter: '{sender_filter}' (empty = any)")
-        print(f"   Subject filter: '{subject_filter}' (empty = any)")
-        print(f"   Attachment required: {attachment_required}")
-        
-        # Apply filters
-        if sender_filter and sender_filter.lower() not in from_email.lower():
-            print(f" Email doesn't match sender filter")
-            print(f"   Expected: {sender_filter}")
-            print(f"   Got: {from_email}")
-            return
-        
-        if subject_filter and subject_filter.lower() not in subject.lower():
-            print(f" Email doesn't match subject filter")
-            print(f"   Expected keyword: '{subject_filter}'")
-            print(f"   Got subject: '{subject}'")
-            return
-        
-        if attachment_required and not has_attachments:
-            print(f"⏭Email doesn't have required attachment")
+        # A flag raised between the last check and the release
+        if not leases.take_flag(lease_name):
             return
-        
-        print(f"Email matches all conditions!")
-        
-        # Get or create workflow execution
-        execution_result = supabase.table("workflow_executions")\
-            .select("*")\
-            .eq("workspace_id", workspace_id)\
-            .eq("user_id", user_id)\
-            .in_("status", ["waiting", "active"])\
-            .execute()
-        
-        if not execution_result.data:
-            # Create new execution
-            execution = supabase.table("workflow_executions").insert({
-                "workspace_id": workspace_id,
-                "user_id": user_id,
-                "status": "active",
-                "current_block_index": 1
-            }).execute()
-            execution_id = execution.data[0]["id"]
-        else:
-            execution_id = execution_result.data[0]["id"]
-        
-        # Build trigger data
-        trigger_data = {
-            "email_id": email['id'],
-            "thread_id": email['threadId'],
-            "subject": subject,
-            "from": from_email,
-            "body": body
+
+
+async def _walk_history(user_id: str, history_id: str, lease_name: str) -> bool:
+    """One pass over the history since the cursor; False if the lease was lost midway"""
+    # Get user's Gmail service
+    service = await get_user_gmail_service_async(user_id)
+    
+    # Get stored history ID and every workspace attached to this mailbox
+    watch_data = supabase.table("gmail_watches")\
+        .select("*")\
+        .eq("user_id", user_id)\
+        .execute()
+    
+    if not watch_data.data:
+        print(f"No watch data found for user {user_id}")
+        return True
+    
+    cursor = min(
+        (w['history_id'] for w in watch_data.data if w.get('history_id')),
+        key=int,
+        default=history_id
+    )
+    workspace_ids = [w['workspace_id'] for w in watch_data.data]
+    
+    user_limit = next(
+        (w['max_concurrency'] for w in watch_data.data if w.get('max_concurrency')),
+        PER_USER_CONCURRENT_MESSAGES
+    )
+    user_slots = _user_semaphore(user_id, user_limit)
+    
+    page_token = None
+    pages = 0
+    total = 0
+    # Set once a page holds a message another worker is still processing:
+    # the cursor must not move past it until that lease is settled
+    held = False
+    while True:
+        request = {
+            'userId': 'me',
+            'startHistoryId': cursor,
+            'historyTypes': ['messageAdded'],
+            'labelId': 'INBOX'
         }
+        if page_token:
+            request['pageToken'] = page_token
         
-        # Update execution with trigger data
-        supabase.table("workflow_executions").update({
-            "status": "running",
-            "trigger_data": trigger_data
-        }).eq("id", execution_id).execute()
-        
-        print(f"Triggering workflow execution {execution_id}")
-        
-        # Execute action blocks (reply-email, etc.) - AWAIT IT!
-        await execute_workflow_blocks(workspace_id, user_id, execution_id, trigger_data)
-        
-        # Reset to waiting for next email
-        supabase.table("workflow_executions").update({
-            "status": "waiting"
-        }).eq("id", execution_id).execute()
+        try:
+            page = await execute_async(user_id, service.users().history().list(**request))
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # The cursor is older than Gmail keeps history (about a week):
+            # restart from the notification, the gap cannot be replayed
+            print(f"History cursor {cursor} expired for user {user_id}, resetting to {history_id}")
+            _save_history_cursor(user_id, history_id)
+            return True
+        
+        records = page.get('history', [])
+        handled, in_progress = await _dispatch_history_page(service, user_id, workspace_ids, records, user_slots)
+        total += handled
+        pages += 1
+        if in_progress and not held:
+            held = True
+            print(f"{in_progress} message(s) still in progress elsewhere, holding history cursor for user {user_id}")
+        
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            break
+        
+        if leases.available and not leases.try_acquire(lease_name, HISTORY_LEASE_SECONDS, fail_open=True):
+            # Another node took over; leave the cursor to it
+            print(f"Lost the history lease for user {user_id} after {pages} page(s)")
+            return False
+        
+        # Checkpoint: everything up to this page's last record is handled
+        if records and not held:
+            _save_history_cursor(user_id, records[-1]['id'])
+    
+    # Last page: the response historyId is the mailbox's current position
+    latest = max((page.get('historyId') or cursor, cursor), key=int)
+    if str(latest) != str(cursor) and not held:
+        _save_history_cursor(user_id, latest)
+    
+    if total:
+        print(f"Handled {total} new messages in {pages} history page(s) for user {user_id}")
+    else:
+        print(f"⏳ No new messages for user {user_id}")
+    return True
+
+
+async def _dispatch_history_page(service, user_id: str, workspace_ids: list, records: list, user_slots) -> tuple[int, int]:
+    """
+    Claim, group and process (or enqueue) one page of history records.
+    Returns once the page is durably handed off, so the caller may checkpoint.
+    
+    Returns:
+        (messages handled, messages skipped because another worker holds them)
+    """
+    # Grouped by thread so replies in a thread stay ordered.
+    # Messages already claimed (redelivered notifications) are dropped here,
+    # before any fetch or LLM call.
+    new_messages = []
+    threads = {}
+    in_progress = 0
+    for record in records:
+        for msg_record in record.get('messagesAdded', []):
+            message = msg_record['message']
+            if not dedupe_store.claim('gmail', user_id, message['id']):
+                if not dedupe_store.is_done('gmail', user_id, message['id']):
+                    in_progress += 1
+                print(f"Skipping already processed message {message['id']}")
+                continue
+            new_messages.append(message['id'])
+            threads.setdefault(message.get('threadId', message['id']), []).append(message['id'])
+    
+    if not new_messages:
+        return 0, in_progress
+    
+    print(f"Found {len(new_messages)} new messages in {len(threads)} threads for user {user_id}")
+    
+    if email_jobs.uses_celery():
+        handed_off = set()
+        try:
+            for message_ids in threads.values():
+                email_jobs.submit_gmail_thread(user_id, workspace_ids, message_ids)
+                handed_off.update(message_ids)
+        except Exception:
+            # Unclaim what never reached the queue so the retry picks it up
+            for message_id in new_messages:
+                if message_id not in handed_off:
+                    dedupe_store.release('gmail', user_id, message_id)
+            raise
+        return len(new_messages), in_progress
+    
+    try:
+        # One batch round trip for the metadata of a multi-message burst
+        prefetched = {}
+        if len(new_messages) > 1:
+            try:
+                prefetched = await fetch_message_metadata_batch(user_id, service, new_messages)
+            except Exception as e:
+                print(f"Batch metadata fetch failed, falling back to single fetches: {e}")
+        
+        # process_new_email settles the claim of every message it starts
+        await asyncio.gather(*(
+            _process_thread_messages(user_id, workspace_ids, message_ids, user_slots, prefetched)
+            for message_ids in threads.values()
+        ))
+    except BaseException:
+        # Cancelled (e.g. by the shutdown drain): messages never started keep
+        # their lease otherwise, and the re-walk of this page would skip them
+        for message_id in new_messages:
+            if not dedupe_store.is_done('gmail', user_id, message_id):
+                dedupe_store.release('gmail', user_id, message_id)
+        raise
+    return len(new_messages), in_progress
+
+
+# Phase 1 mask: ids, labels, headers and part mime types/filenames - no body data
+METADATA_FIELDS = (
+    "id,threadId,labelIds,"
+    "payload(mimeType,filename,headers,"
+    "parts(mimeType,filename,parts(mimeType,filename,parts(mimeType,filename))))"
+)
+# Phase 2 mask: body data of the parts only
+BODY_FIELDS = "payload(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data))))"
+
+
+async def fetch_message_metadata(user_id: str, service, message_id: str) -> dict:
+    """Fetch headers and MIME structure of a message without any part payloads"""
+    return await execute_async(user_id, service.users().messages().get(
+        userId='me',
+        id=message_id,
+        format='full',
+        fields=METADATA_FIELDS
+    ))
+
+
+async def fetch_message_metadata_batch(user_id: str, service, message_ids: list) -> dict:
+    """
+    Fetch phase-1 metadata for many messages through the Gmail batch endpoint.
+    Throttled sub-requests are retried with backoff; other failures are left
+    out of the result so the caller can fall back to a single fetch.
+    
+    Returns:
+        {message_id: message}
+    """
+    results = {}
+    pending = list(dict.fromkeys(message_ids))
+    
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        retry = []
+        
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                retry.append(request_id)
+            else:
+                print(f"Batch fetch failed for message {request_id}: {exception}")
+        
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in pending[start:start + BATCH_SIZE]:
+                batch.add(
+                    service.users().messages().get(
+                        userId='me',
+                        id=message_id,
+                        format='full',
+                        fields=METADATA_FIELDS
+                    ),
+                    request_id=message_id
+                )
+            # Callbacks run on the worker thread that executes the batch
+            await execute_async(user_id, batch)
         
-        print(f"Workflow executed successfully for email {message_id}")
+        if not retry:
+            break
         
+        pending = retry
+        if attempt < BATCH_MAX_RETRIES:
+            print(f"Retrying {len(retry)} throttled message fetches...")
+            await asyncio.sleep(2 ** attempt)
+    
+    return results
+
+
+async def fetch_message_body(user_id: str, service, message_id: str) -> str:
+    """Fetch and decode the text/plain body of a message"""
+    email = await execute_async(user_id, service.users().messages().get(
+        userId='me',
+        id=message_id,
+        format='full',
+        fields=BODY_FIELDS
+    ))
+    return extract_plain_text(email.get('payload', {}))
+
+
+def extract_plain_text(payload: dict) -> str:
+    """Return the first text/plain body found in a (possibly nested) payload"""
+    if 'parts' in payload:
+        for part in payload['parts']:
+            if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
+                return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+        for part in payload['parts']:
+            if part.get('mimeType', '').startswith('multipart/'):
+                text = extract_plain_text(part)
+                if text:
+                    return text
+        return ""
+    if 'data' in payload.get('body', {}):
+        return base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+    return ""
+
+
+async def _profile_address(user_id: str, service) -> str:
+    profile = await execute_async(user_id, service.users().getProfile(userId='me'))
+    return profile['emailAddress']
+
+
+def payload_has_attachments(payload: dict) -> bool:
+    """A part with a filename is an attachment"""
+    for part in payload.get('parts', []):
+        if part.get('filename') or payload_has_attachments(part):
+            return True
+    return False
+
+
+async def _process_thread_messages(
+    user_id: str,
+    workspace_ids: list,
+    message_ids: list,
+    user_slots: asyncio.Semaphore,
+    prefetched: dict
+):
+    """Process one thread's messages in order, bounded by the user and global limits"""
+    for message_id in message_ids:
+        async with user_slots, _global_semaphore():
+            await process_new_email(user_id, workspace_ids, message_id, prefetched.get(message_id))
+
+
+async def process_new_email(
+    user_id: str,
+    workspace_ids: list,
+    message_id: str,
+    email: dict = None,
+    raise_errors: bool = False
+):
+    """
+    Process a single new email - check conditions and trigger workflow.
+    This is the core logic that replaces check_for_emails polling.
+    The message is fetched once and fanned out to every workspace attached
+    to the mailbox whose condition it matches.
+    
+    Args:
+        workspace_ids: all workspaces watching this mailbox
+        email: Phase-1 metadata if already fetched (e.g. by a batch request)
+        raise_errors: re-raise failures (Celery tasks, so their retries fire)
+    """
+    completed = False
+    try:
+        await _handle_new_email(user_id, workspace_ids, message_id, email)
+        completed = True
     except Exception as e:
         print(f"Error processing email {message_id}: {e}")
         import traceback
         traceback.print_exc()
+        if raise_errors:
+            raise
+    finally:
+        # Also runs on cancellation, so an unfinished message stays claimable
+        if completed:
+            dedupe_store.complete('gmail', user_id, message_id)
+        else:
+            dedupe_store.release('gmail', user_id, message_id)
+
+
+async def _handle_new_email(user_id: str, workspace_ids: list, message_id: str, email: dict = None):
+    service = await get_user_gmail_service_async(user_id)
+    
+    # Phase 1: headers and part structure only (no base64 payloads)
+    if email is None:
+        email = await fetch_message_metadata(user_id, service, message_id)
+    
+    # Extract email data
+    headers = email['payload'].get('headers', [])
+    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
+    from_email = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
+    
+    # CRITICAL: Get the user's Gmail address to prevent infinite loops
+    user_email = await mailbox_identities.get(
+        user_id, 'gmail',
+        lookup=lambda: _profile_address(user_id, service)
+    )
+    
+    # FILTER OUT emails sent by the user themselves (prevent catching own replies!)
+    if is_self_sent(from_email, user_email):
+        print(f"⏭Skipping email from self: {from_email}")
+        return
+    
+    print(f"Processing email from {from_email}: {subject}")
+    
+    # Check if email has attachments
+    has_attachments = payload_has_attachments(email['payload'])
+    
+    print(f"📎 Has attachments: {has_attachments}")
+    
+    # One pass over the compiled conditions of every workspace on this mailbox
+    matched = []
+    for workspace_id in workspace_ids:
+        plan = pipeline_plans.get(workspace_id)
+        
+        if plan.condition is None:
+            print(f" No email-received block found in workspace {workspace_id}")
+            continue
+        
+        rejection = plan.matcher.rejection_reason(from_email, subject, has_attachments)
+        if rejection:
+            print(f"⏭Workspace {workspace_id}: email doesn't match conditions: {rejection}")
+            continue
+        
+        matched.append(plan)
+    
+    if not matched:
+        return
+    
+    print(f"Email matches {len(matched)} of {len(workspace_ids)} workspace(s)!")
+    
+    # Phase 2: the body is only needed once the email passed the filters
+    body = await fetch_message_body(user_id, service, message_id)
+    
+    # Build trigger data
+    trigger_data = {
+        "email_id": email['id'],
+        "thread_id": email['threadId'],
+        "subject": subject,
+        "from": from_email,
+        "body": body,
+        "headers": relevant_headers(headers),
+        "label_ids": email.get('labelIds', [])
+    }
+    
+    results = await asyncio.gather(
+        *(trigger_workspace(user_id, plan, trigger_data) for plan in matched),
+        return_exceptions=True
+    )
+    failures = [r for r in results if isinstance(r, Exception)]
+    for plan, result in zip(matched, results):
+        if isinstance(result, Exception):
+            print(f"Workflow failed in workspace {plan.workspace_id}: {result}")
+    
+    # Retry the message only if nothing was delivered; a partial retry
+    # would repeat the workspaces that already ran
+    if failures and len(failures) == len(matched):
+        raise failures[0]
+    
+    print(f"Workflow executed successfully for email {message_id}")
+
+
+async def trigger_workspace(user_id: str, plan, trigger_data: dict):
+    """Run one workspace's pipeline for an email that matched its condition"""
+    workspace_id = plan.workspace_id
+    
+    # Get or create workflow execution
+    execution_result = supabase.table("workflow_executions")\
+        .select("*")\
+        .eq("workspace_id", workspace_id)\
+        .eq("user_id", user_id)\
+        .in_("status", ["waiting", "active"])\
+        .execute()
+    
+    if not execution_result.data:
+        # Create new execution
+        execution = supabase.table("workflow_executions").insert({
+            "workspace_id": workspace_id,
+            "user_id": user_id,
+            "status": "active",
+            "current_block_index": 1
+        }).execute()
+        execution_id = execution.data[0]["id"]
+    else:
+        execution_id = execution_result.data[0]["id"]
+    
+    # Update execution with trigger data
+    supabase.table("workflow_executions").update({
+        "status": "running",
+        "trigger_data": trigger_data
+    }).eq("id", execution_id).execute()
+    
+    print(f"Triggering workflow execution {execution_id}")
+    
+    # Execute action blocks (reply-email, etc.) - AWAIT IT!
+    await execute_workflow_blocks(workspace_id, user_id, execution_id, trigger_data, plan)
+    
+    # Reset to waiting for next email
+    supabase.table("workflow_executions").update({
+        "status": "waiting"
+    }).eq("id", execution_id).execute()
 
 
-async def execute_workflow_blocks(workspace_id: str, user_id: str, execution_id: str, trigger_data: dict):
+async def execute_workflow_blocks(workspace_id: str, user_id: str, execution_id: str, trigger_data: dict, plan=None):
     """
     Execute all action blocks in the workflow after email trigger.
     """
     from blocks.action_reply_email import execute_reply_email
     
-    # Get all blocks for this workspace
-    blocks_result = supabase.table("pipeline_blocks")\
-        .select("*")\
-        .eq("workspace_id", workspace_id)\
-        .order("position")\
-        .execute()
+    if plan is None:
+        plan = pipeline_plans.get(workspace_id)
     
-    blocks = blocks_result.data
-    print(f"Executing {len(blocks)} blocks in workflow")
+    print(f"Executing {len(plan.blocks)} blocks in workflow")
     
     # Skip condition blocks, only execute action blocks
-    action_blocks = [b for b in blocks if b['type'].startswith('action-')]
+    action_blocks = plan.actions
     
     print(f"🎯 Found {len(action_blocks)} action blocks to execute")
     
     for block in action_blocks:
-        block_type = block['type']
-        print(f"\n▶Executing block: {block['title']} ({block_type})")
+        block_type = block.type
+        print(f"\n▶Executing block: {block.title} ({block_type})")
         
         if block_type == 'action-reply-email':
+            if email_jobs.uses_celery():
+                email_jobs.submit_reply(workspace_id, user_id, block.block_id, trigger_data)
+                print(f"Reply queued for LLM workers")
+                continue
+            
             try:
-                # Get block config
-                config_result = supabase.table("block_configs")\
-                    .select("config")\
-                    .eq("workspace_id", workspace_id)\
-                    .eq("block_id", block['block_id'])\
-                    .execute()
-                
-                config = config_result.data[0]['config'] if config_result.data else {}
-                
                 # Execute reply action (await it!)
                 result = await execute_reply_email(
                     workspace_id=workspace_id,
                     user_id=user_id,
                     trigger_data=trigger_data,
-                    config=config
+                    config=block.config
                 )
                 
                 if result.get('status') == 'error':
@@ -1,9 +1,18 @@
 #/handlers/outlook_webhook_handler.py
 import os
 import base64
+import asyncio
+import httpx
 from supabase import create_client
 from dotenv import load_dotenv
 from services.outlook_service import get_outlook_service
+from services.mailbox_router import mailbox_router
+from services.cache_bus import cache_bus
+from services import email_jobs
+from services.dedupe_store import dedupe_store
+from services.mailbox_identity import mailbox_identities, is_self_sent
+from services.email_prefilter import relevant_headers
+from services.pipeline_plan import pipeline_plans
 from blocks.action_reply_email import execute_reply_email
 from datetime import datetime, timedelta, timezone
 
@@ -14,16 +23,60 @@ supabase = create_client(
     os.getenv("SUPABASE_KEY")
 )
 
-def setup_outlook_watch(user_id: str, workspace_id: str):
+# Message properties used by the condition check, pre-filter and reply action
+MESSAGE_FIELDS = "id,subject,from,body,hasAttachments,conversationId,internetMessageHeaders"
+DELTA_FIELDS = MESSAGE_FIELDS + ",receivedDateTime"
+# Overlap with the previous sync so clock skew can't drop a message;
+# the dedupe store absorbs anything seen twice
+DELTA_OVERLAP = timedelta(minutes=int(os.getenv("OUTLOOK_DELTA_OVERLAP_MINUTES", "5")))
+
+# Graph caps message subscriptions at 4230 minutes
+SUBSCRIPTION_LIFETIME = timedelta(days=2)
+
+_delta_locks = {}
+
+async def setup_outlook_watch(user_id: str, workspace_id: str, reuse_existing: bool = True):
     """
     Set up Outlook webhook for new emails
     Microsoft Graph subscriptions expire after max 3 days
+    One subscription serves every workspace on the mailbox
+    
+    Args:
+        reuse_existing: join the mailbox's live subscription if there is one
+                        (False when Graph has already dropped it)
     """
     
     print(f" Setting up Outlook watch for user {user_id}...")
     
     try:
-        service = get_outlook_service(user_id)
+        # Another workspace on this mailbox may already hold a live subscription
+        existing = supabase.table("outlook_watches")\
+            .select("subscription_id, expiration, client_state")\
+            .eq("user_id", user_id)\
+            .execute()
+        now_utc = datetime.now(timezone.utc)
+        shared = reuse_existing and next((
+            w for w in existing.data or []
+            if w.get('subscription_id') and w.get('expiration')
+            and datetime.fromisoformat(w['expiration'].replace('Z', '+00:00')) > now_utc
+        ), None)
+        
+        if shared:
+            supabase.table("outlook_watches").upsert({
+                "user_id": user_id,
+                "workspace_id": workspace_id,
+                "subscription_id": shared['subscription_id'],
+                "expiration": shared['expiration'],
+                "client_state": shared.get('client_state')
+            }, on_conflict="user_id,workspace_id").execute()
+            
+            mailbox_router.add_outlook(shared['subscription_id'], user_id, workspace_id)
+            cache_bus.publish("outlook_watches", {"user_id": user_id, "workspace_id": workspace_id})
+            
+            print(f" Joined existing Outlook subscription {shared['subscription_id']}")
+            return {'id': shared['subscription_id'], 'expirationDateTime': shared['expiration']}
+        
+        service = await get_outlook_service(user_id)
         
         # Create webhook subscription
         # NOTE: For production, use your actual domain. For local dev, use ngrok.
@@ -33,7 +86,7 @@ def setup_outlook_watch(user_id: str, workspace_id: str):
             'changeType': 'created',
             'notificationUrl': notification_url,
             'resource': '/me/mailFolders/inbox/messages',
-            'expirationDateTime': (datetime.now(timezone.utc) + timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%S') + 'Z',
+            'expirationDateTime': subscription_expiry(),
             'clientState': os.getenv("OUTLOOK_CLIENT_STATE", "secretClientState")  # Secret for validation
         }
         
@@ -43,7 +96,7 @@ def setup_outlook_watch(user_id: str, workspace_id: str):
         print(f"   Expiration: {subscription['expirationDateTime']}")
         print(f"   Full subscription: {subscription}")
         
-        result = service._make_request('POST', '/subscriptions', json=subscription)
+        result = await service._make_request('POST', '/subscriptions', json=subscription)
         print(f" Subscription result: {result}")
         
         supabase.table("outlook_watches").upsert({
@@ -54,6 +107,21 @@ def setup_outlook_watch(user_id: str, workspace_id: str):
             "client_state": subscription['clientState']  # add this
         }, on_conflict="user_id,workspace_id").execute()
         
+        # Move any workspaces left on an expired subscription onto the new one
+        supabase.table("outlook_watches").update({
+            "subscription_id": result['id'],
+            "expiration": result['expirationDateTime'],
+            "client_state": subscription['clientState']
+        }).eq("user_id", user_id).execute()
+        
+        mailbox_router.evict_outlook(user_id=user_id)
+        mailbox_router.lookup_outlook(result['id'])
+        mailbox_router.add_outlook(result['id'], user_id, workspace_id)
+        cache_bus.publish("outlook_watches", {"user_id": user_id, "workspace_id": workspace_id})
+        
+        # Pick up anything that arrived while there was no live subscription
+        email_jobs.submit_outlook_delta(user_id)
+        
         print(f" Outlook webhook set up successfully")
         print(f"   Subscription ID: {result['id']}")
         print(f"   Expires: {result['expirationDateTime']}")
@@ -66,7 +134,47 @@ def setup_outlook_watch(user_id: str, workspace_id: str):
         traceback.print_exc()
         raise
 
-def stop_outlook_watch(user_id: str, workspace_id: str):
+def subscription_expiry() -> str:
+    return (datetime.now(timezone.utc) + SUBSCRIPTION_LIFETIME).strftime('%Y-%m-%dT%H:%M:%S') + 'Z'
+
+
+async def renew_outlook_subscription(user_id: str, subscription_id: str):
+    """
+    Extend a Graph subscription in place with PATCH. If Graph no longer
+    knows it (404), a new one is created for the mailbox's workspaces.
+    Either way a delta sync picks up anything missed around the renewal.
+    """
+    service = await get_outlook_service(user_id)
+    try:
+        result = await service._make_request(
+            'PATCH', f'/subscriptions/{subscription_id}',
+            json={'expirationDateTime': subscription_expiry()}
+        )
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            raise
+        print(f" Outlook subscription {subscription_id} is gone, recreating")
+        watch = supabase.table("outlook_watches")\
+            .select("workspace_id")\
+            .eq("subscription_id", subscription_id)\
+            .limit(1)\
+            .execute()
+        if not watch.data:
+            return None
+        # setup_outlook_watch moves every workspace of the mailbox and syncs the delta
+        return await setup_outlook_watch(user_id, watch.data[0]['workspace_id'], reuse_existing=False)
+    
+    supabase.table("outlook_watches").update({
+        "expiration": result['expirationDateTime']
+    }).eq("subscription_id", subscription_id).execute()
+    
+    email_jobs.submit_outlook_delta(user_id)
+    
+    print(f" Outlook subscription {subscription_id} renewed until {result['expirationDateTime']}")
+    return result
+
+
+async def stop_outlook_watch(user_id: str, workspace_id: str):
     """Stop Outlook webhook and delete subscription"""
     
     print(f" Stopping Outlook watch for user {user_id}...")
@@ -85,10 +193,6 @@ def stop_outlook_watch(user_id: str, workspace_id: str):
         
         subscription_id = watch.data[0]['subscription_id']
         
-        # Delete subscription from Microsoft
-        service = get_outlook_service(user_id)
-        service._make_request('DELETE', f'/subscriptions/{subscription_id}')
-        
         # Delete from database
         supabase.table("outlook_watches")\
             .delete()\
@@ -96,6 +200,21 @@ def stop_outlook_watch(user_id: str, workspace_id: str):
             .eq("workspace_id", workspace_id)\
             .execute()
         
+        mailbox_router.remove_outlook(user_id, workspace_id)
+        cache_bus.publish("outlook_watches", {"subscription_id": subscription_id, "user_id": user_id})
+        
+        remaining = supabase.table("outlook_watches")\
+            .select("workspace_id")\
+            .eq("subscription_id", subscription_id)\
+            .execute()
+        if remaining.data:
+            print(f" Outlook subscription kept for {len(remaining.data)} other workspace(s)")
+            return
+        
+        # Delete subscription from Microsoft
+        service = await get_outlook_service(user_id)
+        await service._make_request('DELETE', f'/subscriptions/{subscription_id}')
+        
         print(f" Outlook webhook stopped and deleted")
     
     except Exception as e:
@@ -103,7 +222,90 @@ def stop_outlook_watch(user_id: str, workspace_id: str):
         import traceback
         traceback.print_exc()
 
-async def process_outlook_notification(notification_data: dict, client_state: str):
+def _delta_lock(user_id: str) -> asyncio.Lock:
+    lock = _delta_locks.get(user_id)
+    if lock is None:
+        lock = _delta_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+async def sync_outlook_delta(user_id: str) -> int:
+    """
+    Catch up on inbox mail the webhook never delivered (lapsed subscription,
+    downtime) with a Graph delta query. The deltaLink is kept in
+    outlook_delta_links and only replaced once every page has been
+    processed or enqueued. The first run just establishes the baseline.
+    Mail the webhook already handled is skipped by its done marker in the
+    dedupe store (shared across workers and restarts with DEDUPE_REDIS_URL).
+    
+    Returns:
+        number of new messages handed to the normal processing path
+    """
+    async with _delta_lock(user_id):
+        watches = supabase.table("outlook_watches")\
+            .select("workspace_id")\
+            .eq("user_id", user_id)\
+            .execute()
+        workspace_ids = [w['workspace_id'] for w in watches.data or []]
+        if not workspace_ids:
+            return 0
+        
+        state = supabase.table("outlook_delta_links")\
+            .select("delta_link, synced_at")\
+            .eq("user_id", user_id)\
+            .execute()
+        state = state.data[0] if state.data else None
+        
+        started_at = datetime.now(timezone.utc)
+        service = await get_outlook_service(user_id)
+        
+        if state and state.get('delta_link'):
+            delta_link = state['delta_link']
+            since = datetime.fromisoformat(state['synced_at'].replace('Z', '+00:00')) - DELTA_OVERLAP
+        else:
+            print(f" Starting Outlook delta baseline for user {user_id}")
+            delta_link = None
+            since = started_at
+        
+        handled = 0
+        new_delta_link = None
+        async for messages, page_delta_link in service.inbox_delta(delta_link, select=DELTA_FIELDS, received_since=since):
+            for message in messages:
+                # Deletions and updates to older mail (read flags, moves) also show up in a delta
+                if '@removed' in message or not message.get('receivedDateTime'):
+                    continue
+                received = datetime.fromisoformat(message['receivedDateTime'].replace('Z', '+00:00'))
+                if received < since:
+                    continue
+                
+                message_id = message['id']
+                if not dedupe_store.claim('outlook', user_id, message_id):
+                    continue
+                
+                handled += 1
+                if email_jobs.uses_celery():
+                    try:
+                        email_jobs.submit_outlook_message(user_id, workspace_ids, message_id)
+                    except Exception:
+                        dedupe_store.release('outlook', user_id, message_id)
+                        raise
+                    continue
+                await process_new_outlook_email(user_id, workspace_ids, message_id, message)
+            
+            new_delta_link = page_delta_link or new_delta_link
+        
+        if new_delta_link:
+            supabase.table("outlook_delta_links").upsert({
+                "user_id": user_id,
+                "delta_link": new_delta_link,
+                "synced_at": started_at.isoformat()
+            }, on_conflict="user_id").execute()
+        
+        print(f" Outlook delta sync for user {user_id}: {handled} new message(s)")
+        return handled
+
+
+async def process_outlook_notification(notification_data: dict, client_state: str, raise_errors: bool = False):
     """
     Process Outlook webhook notification from Microsoft Graph
     
@@ -134,17 +336,14 @@ async def process_outlook_notification(notification_data: dict, client_state: st
             
             subscription_id = item['subscriptionId']
             
-            # Find which user this subscription belongs to
-            watch = supabase.table("outlook_watches")\
-                .select("*")\
-                .eq("subscription_id", subscription_id)\
-                .execute()
+            # Find the user and every workspace sharing this subscription
+            routes = mailbox_router.lookup_outlook(subscription_id)
             
-            if not watch.data:
+            if not routes:
                 continue
             
-            user_id = watch.data[0]['user_id']
-            workspace_id = watch.data[0]['workspace_id']
+            user_id = routes[0].user_id
+            workspace_ids = [route.workspace_id for route in routes]
             
             # Extract message ID
             resource_data = item.get('resourceData', {})
@@ -153,127 +352,159 @@ async def process_outlook_notification(notification_data: dict, client_state: st
             if not message_id:
                 continue
             
+            # Graph redelivers notifications; drop duplicates before any Graph/LLM call
+            if not dedupe_store.claim('outlook', user_id, message_id):
+                print(f"  Skipping already processed Outlook message {message_id}")
+                continue
+            
             print(f"  New Outlook email: {message_id}")
             print(f"   User: {user_id}")
-            print(f"   Workspace: {workspace_id}")
+            print(f"   Workspaces: {', '.join(workspace_ids)}")
             
             # Process the email
-            await process_new_outlook_email(user_id, workspace_id, message_id)
+            if email_jobs.uses_celery():
+                try:
+                    email_jobs.submit_outlook_message(user_id, workspace_ids, message_id)
+                except Exception:
+                    dedupe_store.release('outlook', user_id, message_id)
+                    raise
+                continue
+            await process_new_outlook_email(user_id, workspace_ids, message_id)
     
     except Exception as e:
         print(f" Error processing Outlook notification: {e}")
         import traceback
         traceback.print_exc()
+        if raise_errors:
+            raise
 
-async def process_new_outlook_email(user_id: str, workspace_id: str, message_id: str):
+async def process_new_outlook_email(
+    user_id: str,
+    workspace_ids: list,
+    message_id: str,
+    message: dict = None,
+    raise_errors: bool = False
+):
     """
     Process a new Outlook email - check conditions and trigger workflow
     This is called when a new email arrives via webhook
-    """
+    The message is fetched once and fanned out to every matching workspace
     
+    Args:
+        message: MESSAGE_FIELDS projection if already fetched (e.g. by a delta sync)
+        raise_errors: re-raise failures (Celery tasks, so their retries fire)
+    """
+    completed = False
     try:
-        service = get_outlook_service(user_id)
-        
-        # Get message details from Microsoft Graph
-        message = service.get_message(message_id)
-        
-        # Extract email data
-        subject = message.get('subject', '')
-        from_data = message.get('from', {}).get('emailAddress', {})
-        from_email = from_data.get('address', '')
-        from_name = from_data.get('name', '')
-        
-        # Get body (prefer text over HTML)
-        body_data = message.get('body', {})
-        body = body_data.get('content', '')
-        
-        # Get user's email to prevent self-replies
-        user_email = service.get_user_email()
-        
-        # CRITICAL: Filter out emails from self
-        if user_email.lower() == from_email.lower():
-            print(f" Skipping email from self: {from_email}")
-            return
-        
-        print(f" Processing Outlook email from {from_email}: {subject}")
-        
-        # Check for attachments
-        has_attachments = message.get('hasAttachments', False)
-        print(f" Has attachments: {has_attachments}")
-        
-        # Find email-received condition block
-        email_block = supabase.table("pipeline_blocks")\
-            .select("block_id, type")\
-            .eq("workspace_id", workspace_id)\
-            .eq("type", "condition-email-received")\
-            .execute()
+        await _handle_new_outlook_email(user_id, workspace_ids, message_id, message)
+        completed = True
+    except Exception as e:
+        print(f" Error processing Outlook email: {e}")
+        import traceback
+        traceback.print_exc()
+        if raise_errors:
+            raise
+    finally:
+        # Also runs on cancellation, so an unfinished message stays claimable
+        if completed:
+            dedupe_store.complete('outlook', user_id, message_id)
+        else:
+            dedupe_store.release('outlook', user_id, message_id)
+
+
+async def _handle_new_outlook_email(user_id: str, workspace_ids: list, message_id: str, message: dict = None):
+    service = await get_outlook_service(user_id)
+    
+    # Get message details from Microsoft Graph
+    if message is None:
+        message = await service.get_message(message_id, select=MESSAGE_FIELDS)
+    
+    # Extract email data
+    subject = message.get('subject', '')
+    from_data = message.get('from', {}).get('emailAddress', {})
+    from_email = from_data.get('address', '')
+    from_name = from_data.get('name', '')
+    
+    # Get body (prefer text over HTML)
+    body_data = message.get('body', {})
+    body = body_data.get('content', '')
+    
+    # Get user's email to prevent self-replies
+    user_email = await mailbox_identities.get(user_id, 'outlook', lookup=service.get_user_email)
+    
+    # CRITICAL: Filter out emails from self
+    if is_self_sent(from_email, user_email):
+        print(f" Skipping email from self: {from_email}")
+        return
+    
+    print(f" Processing Outlook email from {from_email}: {subject}")
+    
+    # Check for attachments
+    has_attachments = message.get('hasAttachments', False)
+    print(f" Has attachments: {has_attachments}")
+    
+    # One pass over the compiled conditions of every workspace on this mailbox
+    matched = []
+    for workspace_id in workspace_ids:
+        plan = pipeline_plans.get(workspace_id)
         
-        if not email_block.data or len(email_block.data) == 0:
+        if plan.condition is None:
             print(f" No email-received block found in workspace {workspace_id}")
-            return
-        
-        block_id = email_block.data[0]['block_id']
-        print(f" Found email-received block: {block_id}")
-        
-        # Get the config for this block
-        config_result = supabase.table("block_configs")\
-            .select("config")\
-            .eq("workspace_id", workspace_id)\
-            .eq("block_id", block_id)\
-            .execute()
-        
-        email_condition_config = config_result.data[0]['config'] if config_result.data else {}
-        
-        print(f" Checking filters:")
-        
-        # Apply filters (same as Gmail)
-        sender_filter = email_condition_config.get("senderEmail", "")
-        subject_filter = email_condition_config.get("subjectContains", "")
-        attachment_required = email_condition_config.get("hasAttachment", False)
-        
-        print(f"   Sender filter: '{sender_filter}' (empty = any)")
-        print(f"   Subject filter: '{subject_filter}' (empty = any)")
-        print(f"   Attachment required: {attachment_required}")
-        
-        if sender_filter and sender_filter.lower() not in from_email.lower():
-            print(f" Email doesn't match sender filter")
-            print(f"   Expected: {sender_filter}")
-            print(f"   Got: {from_email}")
-            return
-        
-        if subject_filter and subject_filter.lower() not in subject.lower():
-            print(f" Email doesn't match subject filter")
-            print(f"   Expected keyword: '{subject_filter}'")
-            print(f"   Got subject: '{subject}'")
-            return
-        
-        if attachment_required and not has_attachments:
-            print(f" Email doesn't have required attachment")
-            return
-        
-        print(f" Email matches all conditions!")
-        
-        # Build trigger data with provider info
-        trigger_data = {
-            "email_id": message_id,
-            "thread_id": message.get('conversationId'),  # Outlook uses conversationId
-            "subject": subject,
-            "from": f"{from_name} <{from_email}>" if from_name else from_email,
-            "body": body,
-            "provider": "outlook"  # CRITICAL: Mark as Outlook so reply action knows which API to use
-        }
+            continue
         
-        print(f" Triggering workflow for Outlook email")
+        # Apply filters (same compiled condition as Gmail)
+        rejection = plan.matcher.rejection_reason(from_email, subject, has_attachments)
+        if rejection:
+            print(f" Workspace {workspace_id}: email doesn't match conditions: {rejection}")
+            continue
         
-        # Execute workflow blocks (reply-email action will detect provider)
+        matched.append(plan)
+    
+    if not matched:
+        return
+    
+    print(f" Email matches {len(matched)} of {len(workspace_ids)} workspace(s)!")
+    
+    # Build trigger data with provider info
+    trigger_data = {
+        "email_id": message_id,
+        "thread_id": message.get('conversationId'),  # Outlook uses conversationId
+        "subject": subject,
+        "from": f"{from_name} <{from_email}>" if from_name else from_email,
+        "body": body,
+        "headers": relevant_headers(message.get('internetMessageHeaders')),
+        "provider": "outlook"  # CRITICAL: Mark as Outlook so reply action knows which API to use
+    }
+    
+    print(f" Triggering workflow for Outlook email")
+    
+    results = await asyncio.gather(
+        *(execute_outlook_actions(user_id, plan, trigger_data) for plan in matched),
+        return_exceptions=True
+    )
+    failures = [r for r in results if isinstance(r, Exception)]
+    for plan, result in zip(matched, results):
+        if isinstance(result, Exception):
+            print(f" Workflow failed in workspace {plan.workspace_id}: {result}")
+    
+    # Retry only if nothing was delivered (same rule as Gmail)
+    if failures and len(failures) == len(matched):
+        raise failures[0]
+
+
+async def execute_outlook_actions(user_id: str, plan, trigger_data: dict):
+    """Run one workspace's action blocks (reply-email action will detect provider)"""
+    workspace_id = plan.workspace_id
+    for block in plan.actions:
+        if block.type != 'action-reply-email':
+            print(f" Unknown block type: {block.type}")
+            continue
+        if email_jobs.uses_celery():
+            email_jobs.submit_reply(workspace_id, user_id, block.block_id, trigger_data)
+            continue
         await execute_reply_email(
             workspace_id=workspace_id,
             user_id=user_id,
             trigger_data=trigger_data,
-            config={}  # Config loaded inside execute_reply_email
+            config=block.config
         )
-        
-    except Exception as e:
-        print(f" Error processing Outlook email: {e}")
-        import traceback
-        traceback.print_exc()
\ No newline at end of file
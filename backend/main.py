@@ -10,6 +10,15 @@ import base64
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from services.backboard_service import backboard_service
+from services.mailbox_router import mailbox_router
+from services.gmail_service import gmail_clients
+from services.pipeline_plan import pipeline_plans
+from services.cache_bus import cache_bus
+from services.work_queue import work_queue
+from services.watch_renewal import watch_renewal
+from services import email_jobs
+from services.leases import leases
+from services.outlook_service import close_http_client, get_http_client
 import re
 import secrets
 import requests
@@ -19,13 +28,11 @@ from urllib.parse import urlencode
 from datetime import datetime, timedelta, timezone
 from handlers.gmail_webhook_handler import (
     setup_gmail_watch, 
-    stop_gmail_watch, 
-    process_gmail_notification
+    stop_gmail_watch
 )
 from handlers.outlook_webhook_handler import (
     setup_outlook_watch,
-    stop_outlook_watch,
-    process_outlook_notification
+    stop_outlook_watch
 )
 
 
@@ -88,6 +95,69 @@ MICROSOFT_CLIENT_SECRET = os.getenv("MICROSOFT_CLIENT_SECRET")
 
 oauth_states = {}
 
+# Every worker runs the startup hooks. With DEDUPE_REDIS_URL the first to
+# take this lease does the Outlook catch-up for the whole restart; without
+# it every node catches up unless OUTLOOK_CATCH_UP_ENABLED=false (set it on
+# all but one node of a multi-node deployment)
+OUTLOOK_CATCH_UP_ENABLED = os.getenv("OUTLOOK_CATCH_UP_ENABLED", "true").lower() == "true"
+OUTLOOK_CATCH_UP_LEASE_SECONDS = int(os.getenv("OUTLOOK_CATCH_UP_LEASE_SECONDS", "600"))
+
+
+@app.on_event("startup")
+async def start_work_queue():
+    email_jobs.check_config()
+    work_queue.start()
+
+
+@app.on_event("shutdown")
+async def drain_work_queue():
+    await work_queue.drain()
+    await close_http_client()
+
+
+@app.on_event("startup")
+async def catch_up_outlook_mailboxes():
+    """Recover Outlook mail that arrived while the server was down"""
+    if not OUTLOOK_CATCH_UP_ENABLED:
+        print("Outlook catch-up disabled on this node (OUTLOOK_CATCH_UP_ENABLED=false)")
+        return
+    if leases.available and not leases.try_acquire("outlook-catch-up", OUTLOOK_CATCH_UP_LEASE_SECONDS):
+        print("Skipping Outlook catch-up: another node holds the lease")
+        return
+    try:
+        watches = supabase.table("outlook_watches").select("user_id").execute()
+        for user_id in {w['user_id'] for w in watches.data or []}:
+            email_jobs.submit_outlook_delta(user_id)
+    finally:
+        leases.release("outlook-catch-up")
+
+
+@app.on_event("startup")
+async def start_cache_bus():
+    cache_bus.start()
+
+
+@app.on_event("startup")
+async def load_mailbox_routes():
+    await asyncio.get_event_loop().run_in_executor(executor, mailbox_router.load)
+
+
+@app.on_event("startup")
+async def warm_backboard_pool():
+    backboard_service.thread_pool.start()
+
+
+@app.on_event("startup")
+async def start_gmail_token_refresher():
+    app.state.gmail_token_refresher = asyncio.create_task(gmail_clients.run_refresher())
+
+
+@app.on_event("startup")
+async def start_watch_renewal():
+    # With DEDUPE_REDIS_URL every worker competes for the renewal lease and one
+    # renews at a time; without it see WATCH_RENEWAL_ENABLED in services/watch_renewal.py
+    app.state.watch_renewal = asyncio.create_task(watch_renewal.run())
+
 
 # AUTH ENDPOINTS
 
@@ -165,6 +235,8 @@ async def auth_gmail_callback(state: str, code: str):
         "scope": " ".join(SCOPES),
         "email": gmail_email 
     }).execute()
+    gmail_clients.invalidate(user_id)
+    cache_bus.publish("user_oauth_credentials", {"user_id": user_id, "provider": "gmail"})
     
     del oauth_states[state]
     return RedirectResponse(frontend_redirect)
@@ -203,7 +275,8 @@ async def auth_outlook_callback(state: str, code: str):
     
     print(f"Outlook OAuth callback received for user {user_id}")
     
-    response = requests.post(
+    graph_client = get_http_client()
+    response = await graph_client.post(
         "https://login.microsoftonline.com/common/oauth2/v2.0/token",
         data={
             'client_id': MICROSOFT_CLIENT_ID,
@@ -215,19 +288,19 @@ async def auth_outlook_callback(state: str, code: str):
         }
     )
     
-    if not response.ok:
+    if not response.is_success:
         print(f"Token exchange failed: {response.text}")
         raise HTTPException(status_code=500, detail="Failed to get access token")
     
     tokens = response.json()
     token_expiry = (datetime.now(timezone.utc) + timedelta(seconds=tokens.get('expires_in', 3600))).isoformat()
 
-    me_response = requests.get(
+    me_response = await graph_client.get(
     'https://graph.microsoft.com/v1.0/me',
     headers={'Authorization': f'Bearer {tokens["access_token"]}'}
     )
     outlook_email = ''
-    if me_response.ok:
+    if me_response.is_success:
         me_data = me_response.json()
         outlook_email = me_data.get('mail') or me_data.get('userPrincipalName', '')
 
@@ -241,6 +314,7 @@ async def auth_outlook_callback(state: str, code: str):
         "scope": ' '.join(MICROSOFT_SCOPES),
         "email": outlook_email
     }).execute()
+    cache_bus.publish("user_oauth_credentials", {"user_id": user_id, "provider": "outlook"})
     
     print(f"Outlook OAuth complete for user {user_id}")
     return RedirectResponse(frontend_redirect)
@@ -306,6 +380,8 @@ async def launch_workflow(workspace_id: str, body: LaunchRequest):
     execution_id = result.data[0]["id"]
     
     try:
+        pipeline_plans.rebuild(workspace_id)
+        
         if has_gmail:
             watch_result = setup_gmail_watch(body.user_id, workspace_id)
             print(f"Gmail webhook active")
@@ -313,9 +389,7 @@ async def launch_workflow(workspace_id: str, body: LaunchRequest):
             print(f"   Expires: {watch_result['expiration']}")
         
         if has_outlook:
-            await asyncio.get_event_loop().run_in_executor(
-                executor, setup_outlook_watch, body.user_id, workspace_id
-            )
+            await setup_outlook_watch(body.user_id, workspace_id)
             print(f" Outlook webhook active")
         
         return {
@@ -350,7 +424,7 @@ async def stop_workflow(workspace_id: str, body: LaunchRequest):
         print(f"Could not stop Gmail webhook: {e}")
     
     try:
-        stop_outlook_watch(body.user_id, workspace_id)
+        await stop_outlook_watch(body.user_id, workspace_id)
         print(f" Outlook webhook stopped")
     except Exception as e:
         print(f"Could not stop Outlook webhook: {e}")
@@ -359,6 +433,8 @@ async def stop_workflow(workspace_id: str, body: LaunchRequest):
         supabase.table("workflow_executions")\
             .update({"status": "paused"}).eq("id", execution_id).execute()
     
+    pipeline_plans.invalidate(workspace_id)
+    
     return {
         "status": "paused",
         "stopped_count": len(active_ids),
@@ -427,6 +503,9 @@ async def save_block_config(block_id: str, body: BlockConfig):
         "config": body.config
     }).execute()
     
+    pipeline_plans.refresh(body.workspace_id)
+    cache_bus.publish("block_configs", {"workspace_id": body.workspace_id, "block_id": block_id})
+    
     return {"success": True, "message": "Configuration saved"}
 
 
@@ -460,21 +539,18 @@ async def gmail_webhook(request: Request):
                 print("Missing email or history ID")
                 return {"status": "ignored"}
             
-            creds_result = supabase.table("user_oauth_credentials")\
-                .select("user_id").eq("provider", "gmail").execute()
+            routes = mailbox_router.lookup_gmail(email_address)
+            
+            if not routes:
+                return {"status": "no_active_watch"}
             
-            for cred in creds_result.data:
-                user_id = cred['user_id']
-                
-                watch_result = supabase.table("gmail_watches")\
-                    .select("*").eq("user_id", user_id).execute()
-                
-                if watch_result.data and len(watch_result.data) > 0:
-                    print(f"Found matching user: {user_id}")
-                    await process_gmail_notification(user_id, history_id)
-                    return {"status": "processed"}
+            user_id = routes[0].user_id
+            print(f"Found matching user: {user_id} ({len(routes)} workspace(s))")
             
-            return {"status": "no_active_watch"}
+            # Ack within the Pub/Sub deadline; processing happens in the worker pool
+            if not email_jobs.submit_gmail_notification(user_id, history_id):
+                return Response(status_code=503)
+            return Response(status_code=204)
         
         return {"status": "success"}
         
@@ -502,7 +578,8 @@ async def outlook_webhook(request: Request):
         if 'value' in body and len(body['value']) > 0:
             client_state = body['value'][0].get('clientState', '')
         
-        asyncio.create_task(process_outlook_notification(body, client_state))
+        if not email_jobs.submit_outlook_notification(body, client_state):
+            return Response(status_code=503)
         return Response(status_code=202)
     
     except Exception as e:
@@ -510,6 +587,14 @@ async def outlook_webhook(request: Request):
         return Response(status_code=202)
 
 
+@app.post("/outlook/{user_id}/sync")
+async def sync_outlook_mailbox(user_id: str):
+    """On-demand Outlook catch-up through the delta query"""
+    if not email_jobs.submit_outlook_delta(user_id):
+        return Response(status_code=503)
+    return Response(status_code=202)
+
+
 # VOICE COMMAND ENDPOINT
 
 WORKFLOW_TEMPLATES = [
@@ -564,18 +649,6 @@ async def handle_voice_command(body: VoiceCommandRequest):
         
         print(f"No template match, trying AI generation...")
         
-        try:
-            thread_id = await backboard_service.create_thread()
-        except Exception as backboard_error:
-            if "429" in str(backboard_error) or "quota" in str(backboard_error).lower():
-                return {
-                    "success": True,
-                    "blocks": WORKFLOW_TEMPLATES[0]["blocks"],
-                    "message": "I've created a workflow for you!",
-                    "source": "fallback-quota"
-                }
-            raise
-        
         system_context = f"""You are a friendly workflow automation assistant.
 
 The user said: "{body.transcription}"
@@ -600,12 +673,7 @@ Choose action-reply-email when the user wants to respond/reply to emails.
 Choose action-send-email when the user wants to send/forward emails."""
 
         try:
-            ai_response = await backboard_service.add_message_and_get_reply(
-                thread_id=thread_id,
-                sender_email=body.user_id,
-                subject="Voice Command",
-                body=system_context
-            )
+            ai_response = await backboard_service.complete(system_context)
             
             cleaned = ai_response.strip()
             if cleaned.startswith("```"):
@@ -618,12 +686,18 @@ Choose action-send-email when the user wants to send/forward emails."""
                     "success": True,
                     "blocks": workflow_data.get("blocks", []),
                     "message": workflow_data.get("message", "Workflow created!"),
-                    "source": "ai",
-                    "thread_id": thread_id
+                    "source": "ai"
                 }
         
         except Exception as e:
             print(f"AI generation failed: {e}")
+            if "429" in str(e) or "quota" in str(e).lower():
+                return {
+                    "success": True,
+                    "blocks": WORKFLOW_TEMPLATES[0]["blocks"],
+                    "message": "I've created a workflow for you!",
+                    "source": "fallback-quota"
+                }
         
         return {
             "success": True,
@@ -3,13 +3,112 @@ Backboard.io integration service for AI email responses with memory.
 NOW WITH: Smart reply decision - AI decides if response is needed.
 """
 import os
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
 from backboard import BackboardClient
 from dotenv import load_dotenv
+from services.reply_decision import ReplyDecision, parse_reply_decision
 
 load_dotenv()
 
 BACKBOARD_API_KEY = os.getenv("BACKBOARD_API_KEY")
 
+# Pre-created threads kept warm for stateless (memory off) prompts
+POOL_SIZE = int(os.getenv("BACKBOARD_POOL_SIZE", "4"))
+# Prompts per pooled thread. A thread keeps its message history even with
+# memory off, and the pool is shared by every workspace and prompt kind, so
+# the default of 1 only pre-warms fresh threads. Raising it lets one
+# tenant's emails become context for another's prompts. Retired threads
+# are deleted in the background.
+POOL_MAX_USES = int(os.getenv("BACKBOARD_POOL_MAX_USES", "1"))
+# Conversation messages quoted into a scratch-thread prompt for context
+HISTORY_MESSAGES = int(os.getenv("BACKBOARD_HISTORY_MESSAGES", "10"))
+
+# Shared by the standalone decision prompt and the combined decide-and-reply prompt
+REPLY_DECISION_RULES = """ONLY reply YES if:
+- It's a direct question to me
+- It requires action or acknowledgment from me
+- It's a conversation I'm actively having with this person
+
+DO NOT reply (say NO) if:
+- It's automated (newsletters, notifications, receipts, login links, confirmations)
+- It's from a no-reply address
+- It's clearly not meant for me (forwarded emails, CC'd, system emails)
+- It's just FYI/informational
+- It's a marketing/promotional email
+- It's a login link, password reset, verification code"""
+
+
+class ThreadPool:
+    """
+    Leased, pre-created threads for stateless prompts.
+    A thread is held by one prompt at a time and retired after max_uses
+    (by default after its first prompt). Refills and deletion of retired
+    threads run in the background.
+    """
+    
+    def __init__(self, create_thread, delete_thread, size: int = POOL_SIZE, max_uses: int = POOL_MAX_USES):
+        self._create_thread = create_thread
+        self._delete_thread = delete_thread
+        self.size = size
+        self.max_uses = max(1, max_uses)
+        self._idle = deque()  # [thread_id, uses]
+        self._refill_task = None
+        self._retiring = set()
+    
+    def start(self):
+        """Begin filling the pool (needs a running event loop)"""
+        self._schedule_refill()
+    
+    def _schedule_refill(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.get_running_loop().create_task(self._refill())
+    
+    async def _refill(self):
+        while len(self._idle) < self.size:
+            try:
+                thread_id = await self._create_thread()
+            except Exception as e:
+                print(f"Backboard pool refill failed: {e}")
+                return
+            self._idle.append([thread_id, 0])
+    
+    def _retire(self, thread_id: str):
+        task = asyncio.get_running_loop().create_task(self._delete(thread_id))
+        self._retiring.add(task)
+        task.add_done_callback(self._retiring.discard)
+    
+    async def _delete(self, thread_id: str):
+        try:
+            await self._delete_thread(thread_id)
+        except Exception as e:
+            print(f"Could not delete retired Backboard thread {thread_id}: {e}")
+    
+    @asynccontextmanager
+    async def lease(self):
+        if self._idle:
+            entry = self._idle.popleft()
+        else:
+            # Pool ran dry, pay for the round trip this once
+            entry = [await self._create_thread(), 0]
+        
+        try:
+            yield entry[0]
+        except BaseException:
+            # Don't reuse a thread left in an unknown state
+            self._retire(entry[0])
+            self._schedule_refill()
+            raise
+        
+        entry[1] += 1
+        if entry[1] < self.max_uses and len(self._idle) < self.size:
+            self._idle.append(entry)
+        else:
+            self._retire(entry[0])
+        self._schedule_refill()
+
+
 class BackboardService:
     """Service for interacting with Backboard.io API"""
     
@@ -22,6 +121,7 @@ class BackboardService:
         
         # Initialize the official SDK client
         self.client = BackboardClient(api_key=self.api_key)
+        self.thread_pool = ThreadPool(self.create_thread, self.delete_thread)
     
     async def create_thread(self) -> str:
         """
@@ -34,6 +134,9 @@ class BackboardService:
         thread = await self.client.create_thread(self.assistant_id)
         return str(thread.thread_id)
     
+    async def delete_thread(self, thread_id: str):
+        await self.client.delete_thread(thread_id)
+    
     async def should_reply_to_email(
         self,
         sender_email: str,
@@ -46,9 +149,6 @@ class BackboardService:
         Returns:
             (should_reply: bool, reason: str)
         """
-        # Create a temporary thread just for this decision
-        temp_thread = await self.create_thread()
-        
         decision_prompt = f"""You are an email assistant deciding if an email needs a response.
 
 Analyze this email and decide: Should I reply?
@@ -57,18 +157,7 @@ From: {sender_email}
 Subject: {subject}
 Body: {body}
 
-ONLY reply YES if:
-- It's a direct question to me
-- It requires action or acknowledgment from me
-- It's a conversation I'm actively having with this person
-
-DO NOT reply (say NO) if:
-- It's automated (newsletters, notifications, receipts, login links, confirmations)
-- It's from a no-reply address
-- It's clearly not meant for me (forwarded emails, CC'd, system emails)
-- It's just FYI/informational
-- It's a marketing/promotional email
-- It's a login link, password reset, verification code
+{REPLY_DECISION_RULES}
 
 Respond with ONLY:
 YES - [brief reason]
@@ -82,14 +171,7 @@ Examples:
 - "Thanks for your help!" → YES - acknowledges assistance, brief reply appropriate
 - "Newsletter: Top 10 tips" → NO - marketing email"""
 
-        response = await self.client.add_message(
-            thread_id=temp_thread,
-            content=decision_prompt,
-            memory="Off",  # No memory needed for this decision
-            stream=False
-        )
-        
-        decision = response.content.strip()
+        decision = (await self.complete(decision_prompt)).strip()
         
         # Parse the response
         if decision.upper().startswith("YES"):
@@ -97,6 +179,58 @@ Examples:
         else:
             return (False, decision)
     
+    async def complete(self, prompt: str, memory: str = "Off") -> str:
+        """
+        One prompt on a pooled scratch thread (no thread creation).
+        
+        Args:
+            memory: "Off", or "Readonly" to draw on memory without adding to it
+        """
+        async with self.thread_pool.lease() as thread_id:
+            response = await self.client.add_message(
+                thread_id=thread_id,
+                content=prompt,
+                memory=memory,
+                stream=False
+            )
+        return response.content
+    
+    async def recent_history(self, thread_id: str, limit: int = HISTORY_MESSAGES) -> str:
+        """The last messages of a conversation thread as plain text, oldest first"""
+        thread = await self.client.get_thread(thread_id)
+        lines = [
+            f"{getattr(message.role, 'value', message.role)}: {message.content.strip()}"
+            for message in thread.messages[-limit:] if message.content
+        ]
+        return "\n\n".join(lines)
+    
+    async def complete_with_history(self, thread_id: str, prompt: str) -> str:
+        """
+        Answer on a pooled scratch thread with read-only memory, quoting the
+        conversation thread's history so the reply keeps its context while
+        nothing is written to the conversation thread itself.
+        """
+        history = await self.recent_history(thread_id)
+        if history:
+            prompt = f"Conversation so far:\n{history}\n\nNew email:\n{prompt}"
+        return await self.complete(prompt, memory="Readonly")
+    
+    async def record_exchange(self, thread_id: str, body: str, reply: str, label: str = "[Reply sent]"):
+        """
+        Append an email and the reply that was produced elsewhere (e.g. on a
+        scratch thread) to a conversation thread, without another LLM call.
+        
+        Args:
+            label: what happened to the reply, "[Reply sent]" or "[Draft created]"
+        """
+        await self.client.add_message(
+            thread_id=thread_id,
+            content=f"{body.strip()}\n\n{label}\n{reply.strip()}",
+            memory="Auto",
+            send_to_llm="false",
+            stream=False
+        )
+    
     async def add_message_and_get_reply(
         self, 
         thread_id: str, 
@@ -119,6 +253,48 @@ Examples:
         )
         
         return response.content
+    
+    async def decide_and_reply(
+        self,
+        thread_id: str,
+        sender_email: str,
+        subject: str,
+        body: str
+    ) -> ReplyDecision:
+        """
+        Decide and draft in ONE call on the conversation thread.
+        Replaces should_reply_to_email + add_message_and_get_reply
+        (temp thread, decision message, reply message).
+        
+        Args:
+            body: the message content to answer (may already carry custom instructions)
+        """
+        prompt = f"""You are an email assistant. Decide if this email needs a response and, if it does, write the response.
+
+From: {sender_email}
+Subject: {subject}
+
+{REPLY_DECISION_RULES}
+
+Respond in EXACTLY this format:
+DECISION: YES - [brief reason]
+REPLY:
+[the full reply text]
+
+or, when no reply is needed:
+DECISION: NO - [brief reason]
+
+Email:
+{body}"""
+
+        response = await self.client.add_message(
+            thread_id=thread_id,
+            content=prompt,
+            memory="Auto",
+            stream=False
+        )
+        
+        return parse_reply_decision(response.content)
 
 
 # Singleton instance
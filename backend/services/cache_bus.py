@@ -0,0 +1,135 @@
+"""
+Cross-node cache invalidation bus.
+In-process caches (pipeline plans, mailbox routes, Gmail clients) subscribe
+to table names here. The bus listens for row changes on those tables and
+hands each changed row to the subscribers so they can evict stale entries.
+Subscribers may restrict themselves to some event types (INSERT, UPDATE,
+DELETE); events announced with publish() carry no type and reach everyone.
+
+Backends (CACHE_BUS_BACKEND):
+- realtime (default): Supabase Realtime postgres changes. DELETE events
+  only carry the full old row if the table has REPLICA IDENTITY FULL.
+- redis: Redis pub/sub on CACHE_BUS_CHANNEL, for local testing. Writers
+  announce their changes with cache_bus.publish().
+- off: local dispatch only.
+"""
+import os
+import json
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKEND = os.getenv("CACHE_BUS_BACKEND", "realtime")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+CHANNEL = os.getenv("CACHE_BUS_CHANNEL", "cache-invalidation")
+RECONNECT_DELAY_SECONDS = 5
+ANY_EVENT = "*"
+
+WATCHED_TABLES = (
+    "block_configs",
+    "pipeline_blocks",
+    "gmail_watches",
+    "outlook_watches",
+    "user_oauth_credentials",
+    "sender_reputation",
+)
+
+
+def _realtime_url() -> str:
+    host = os.getenv("SUPABASE_URL", "").replace("https://", "wss://").replace("http://", "ws://")
+    return f"{host}/realtime/v1/websocket?apikey={os.getenv('SUPABASE_KEY')}&vsn=1.0.0"
+
+
+class CacheBus:
+    """Fan-out of table change events to local cache subscribers"""
+
+    def __init__(self, backend: str = BACKEND):
+        self.backend = backend
+        self._handlers = defaultdict(list)
+        self._thread = None
+        self._redis = None
+
+    def subscribe(self, table: str, handler, events: tuple = None):
+        """Register handler(row: dict) for changes on table, optionally only for some event types"""
+        self._handlers[table].append((handler, events))
+
+    def dispatch(self, table: str, row: dict, event: str = ANY_EVENT):
+        for handler, events in self._handlers.get(table, []):
+            if events and event != ANY_EVENT and event not in events:
+                continue
+            try:
+                handler(row or {})
+            except Exception as e:
+                print(f"Cache invalidation handler failed for {table}: {e}")
+
+    def publish(self, table: str, row: dict):
+        """
+        Announce a local write to other nodes.
+        With the realtime backend the database change itself is the event,
+        so this only matters for redis.
+        """
+        if self.backend != "redis":
+            return
+        try:
+            if self._redis is None:
+                import redis
+                self._redis = redis.Redis.from_url(REDIS_URL)
+            self._redis.publish(CHANNEL, json.dumps({"table": table, "row": row}, default=str))
+        except Exception as e:
+            print(f"Could not publish cache invalidation for {table}: {e}")
+            # Keep at least this node consistent
+            self.dispatch(table, row)
+
+    def start(self):
+        if self.backend == "off" or self._thread is not None:
+            return
+        target = self._run_redis if self.backend == "redis" else self._run_realtime
+        self._thread = threading.Thread(target=self._supervise, args=(target,), name="cache-bus", daemon=True)
+        self._thread.start()
+        print(f"Cache invalidation bus started ({self.backend})")
+
+    def _supervise(self, target):
+        while True:
+            try:
+                target()
+            except Exception as e:
+                print(f"Cache invalidation bus disconnected: {e}")
+            time.sleep(RECONNECT_DELAY_SECONDS)
+
+    def _run_realtime(self):
+        from realtime.connection import Socket
+
+        # Socket drives its own event loop, so give this thread one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        socket = Socket(_realtime_url())
+        socket.connect()
+        for table in WATCHED_TABLES:
+            channel = socket.set_channel(f"realtime:public:{table}")
+            channel.join().on("*", lambda payload, table=table: self._on_realtime(table, payload))
+        socket.listen()
+
+    def _on_realtime(self, table: str, payload: dict):
+        old = payload.get("old_record") or payload.get("old") or {}
+        new = payload.get("record") or payload.get("new") or {}
+        self.dispatch(table, {**old, **new}, (payload.get("type") or ANY_EVENT).upper())
+
+    def _run_redis(self):
+        import redis
+
+        pubsub = redis.Redis.from_url(REDIS_URL).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CHANNEL)
+        for message in pubsub.listen():
+            try:
+                event = json.loads(message["data"])
+            except (TypeError, ValueError):
+                continue
+            self.dispatch(event.get("table"), event.get("row"))
+
+
+# Singleton instance
+cache_bus = CacheBus()
@@ -0,0 +1,170 @@
+"""
+Compiled matcher for condition-email-received blocks.
+A block config is compiled once (as part of the pipeline plan) into hash
+sets for sender addresses and domains, an Aho-Corasick automaton for
+subject keywords and a tuple of compiled regexes, so evaluating an email
+costs the same whether a sender or keyword list holds ten entries or ten
+thousand. Regex patterns are compiled one by one so each keeps its own
+groups and inline flags.
+
+Config keys:
+    senderEmail       legacy: substring the From header must contain
+    subjectContains   legacy: substring the subject must contain
+    hasAttachment     the email must have an attachment
+    senderAllowList   addresses / domains; when set the sender must match one
+    senderDenyList    addresses / domains; a match always rejects
+    subjectKeywords   the subject must contain at least one keyword
+    subjectRegex      the subject must match at least one pattern
+
+List values may be JSON lists or strings separated by newlines or commas.
+Domain entries ("acme.com" or "@acme.com") also match subdomains. All
+matching is case-insensitive.
+"""
+import re
+from collections import deque
+from email.utils import parseaddr
+from typing import Optional
+
+NEVER = re.compile(r"(?!)")
+
+
+def parse_address(value: str) -> str:
+    """'Jane <Jane@Example.com>' -> 'jane@example.com' (kept local so the engine has no I/O imports)"""
+    return parseaddr(value or "")[1].strip().lower()
+
+
+def _entries(value) -> list:
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = re.split(r"[\n,]", value)
+    return [str(v).strip().lower() for v in value if str(v).strip()]
+
+
+class SenderSet:
+    """Exact addresses and domains (with their subdomains) in two hash sets"""
+
+    def __init__(self, entries: list):
+        self.addresses = set()
+        self.domains = set()
+        for entry in entries:
+            if "@" in entry.lstrip("@"):
+                self.addresses.add(parse_address(entry) or entry)
+            else:
+                self.domains.add(entry.lstrip("@").lstrip("."))
+
+    def __bool__(self):
+        return bool(self.addresses or self.domains)
+
+    def __contains__(self, address: str) -> bool:
+        if address in self.addresses:
+            return True
+        # bob@mail.acme.com -> mail.acme.com, acme.com, com
+        labels = address.rpartition("@")[2].split(".")
+        return any(".".join(labels[i:]) in self.domains for i in range(len(labels)))
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton: does the text contain any of the keywords?"""
+
+    def __init__(self, keywords: list):
+        self._goto = [{}]
+        self._fail = [0]
+        self._terminal = [False]
+
+        for keyword in keywords:
+            state = 0
+            for char in keyword:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._terminal.append(False)
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._terminal[state] = True
+
+        # Breadth-first failure links; a state is terminal if any suffix is
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._terminal[child] = self._terminal[child] or self._terminal[self._fail[child]]
+
+        self.empty = len(self._goto) == 1
+
+    def search(self, text: str) -> bool:
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._terminal[state]:
+                return True
+        return False
+
+
+def _compile_patterns(patterns: list) -> tuple:
+    compiled = []
+    for pattern in patterns:
+        try:
+            compiled.append(re.compile(pattern, re.IGNORECASE))
+        except re.error as e:
+            print(f"Rejected invalid subjectRegex {pattern!r}: {e}")
+    if not compiled:
+        # Every configured pattern was invalid: match nothing rather than everything
+        return (NEVER,)
+    return tuple(compiled)
+
+
+class CompiledCondition:
+    """An email-received config compiled for constant-cost evaluation"""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.sender_contains = (config.get("senderEmail") or "").strip().lower()
+        self.subject_contains = (config.get("subjectContains") or "").strip().lower()
+        self.attachment_required = bool(config.get("hasAttachment", False))
+        self.allow = SenderSet(_entries(config.get("senderAllowList")))
+        self.deny = SenderSet(_entries(config.get("senderDenyList")))
+        self.keywords = KeywordAutomaton(_entries(config.get("subjectKeywords")))
+
+        patterns = config.get("subjectRegex")
+        if isinstance(patterns, str):
+            patterns = [p for p in patterns.splitlines() if p.strip()]
+        self.subject_patterns = _compile_patterns(list(patterns)) if patterns else ()
+
+    def rejection_reason(self, from_header: str, subject: str, has_attachments: bool) -> Optional[str]:
+        """Why the email does not match the condition, or None when it matches"""
+        address = parse_address(from_header)
+        subject_lower = (subject or "").lower()
+
+        if self.deny and address in self.deny:
+            return f"sender {address} is on the deny list"
+
+        if self.allow and address not in self.allow:
+            return f"sender {address} is not on the allow list"
+
+        if self.sender_contains and self.sender_contains not in (from_header or "").lower():
+            return f"sender doesn't contain '{self.sender_contains}'"
+
+        if self.subject_contains and self.subject_contains not in subject_lower:
+            return f"subject doesn't contain '{self.subject_contains}'"
+
+        if not self.keywords.empty and not self.keywords.search(subject_lower):
+            return "subject contains none of the keywords"
+
+        if self.subject_patterns and not any(p.search(subject or "") for p in self.subject_patterns):
+            return "subject matches none of the patterns"
+
+        if self.attachment_required and not has_attachments:
+            return "email doesn't have the required attachment"
+
+        return None
+
+
+MATCH_ALL = CompiledCondition()
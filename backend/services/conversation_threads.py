@@ -0,0 +1,108 @@
+"""
+Conversation -> Backboard thread mapping.
+Each (workspace_id, conversation_key) owns exactly one Backboard thread so
+a sender's memory is never split. Lookups are served from an in-process
+LRU. Concurrent misses for the same key share one in-flight creation, and
+the email_conversations upsert (unique on workspace_id, conversation_key)
+settles races between processes.
+"""
+import os
+import asyncio
+import threading
+from typing import Optional
+from cachetools import LRUCache
+from supabase import create_client
+from dotenv import load_dotenv
+from services.backboard_service import backboard_service
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+CACHE_SIZE = int(os.getenv("CONVERSATION_THREAD_CACHE_SIZE", "10000"))
+
+
+class ConversationThreadMap:
+    """(workspace_id, conversation_key) -> backboard_thread_id"""
+
+    def __init__(self, maxsize: int = CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._threads = LRUCache(maxsize=maxsize)
+        self._in_flight = {}
+
+    def _lookup(self, workspace_id: str, conversation_key: str) -> Optional[str]:
+        result = supabase.table("email_conversations")\
+            .select("backboard_thread_id")\
+            .eq("workspace_id", workspace_id)\
+            .eq("conversation_key", conversation_key)\
+            .limit(1)\
+            .execute()
+        return result.data[0]["backboard_thread_id"] if result.data else None
+
+    async def get_or_create(
+        self,
+        workspace_id: str,
+        conversation_key: str,
+        user_id: str,
+        sender_email: str
+    ) -> str:
+        key = (workspace_id, conversation_key)
+        with self._lock:
+            thread_id = self._threads.get(key)
+        if thread_id:
+            return thread_id
+
+        # Single flight: later callers wait on the first caller's result
+        pending = self._in_flight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            thread_id = await self._resolve(workspace_id, conversation_key, user_id, sender_email)
+            with self._lock:
+                self._threads[key] = thread_id
+            future.set_result(thread_id)
+            return thread_id
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Waiters get the exception; don't leave it unretrieved if there are none
+            future.exception()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+    async def _resolve(self, workspace_id: str, conversation_key: str, user_id: str, sender_email: str) -> str:
+        thread_id = self._lookup(workspace_id, conversation_key)
+        if thread_id:
+            print(f"Using existing Backboard thread: {thread_id}")
+            return thread_id
+
+        print(f"Creating new Backboard thread for conversation: {conversation_key}")
+        thread_id = await backboard_service.create_thread()
+
+        supabase.table("email_conversations").upsert({
+            "conversation_key": conversation_key,
+            "backboard_thread_id": thread_id,
+            "workspace_id": workspace_id,
+            "user_id": user_id,
+            "sender_email": sender_email
+        }, on_conflict="workspace_id,conversation_key", ignore_duplicates=True).execute()
+
+        # Another process may have won the insert; its thread is the one to use
+        winner = self._lookup(workspace_id, conversation_key)
+        if winner and winner != thread_id:
+            print(f"Lost thread creation race for {conversation_key}, using {winner}")
+            return winner
+        return thread_id
+
+
+# Singleton instance
+conversation_threads = ConversationThreadMap()
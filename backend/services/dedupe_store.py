@@ -0,0 +1,122 @@
+"""
+Idempotency store for inbound notifications.
+Pub/Sub and Microsoft Graph both redeliver notifications; claiming each
+(provider, user, message_id) before any provider or LLM call makes the
+redelivery a no-op. A bounded in-memory LRU/TTL tier is always used; set
+DEDUPE_REDIS_URL to share claims across workers and nodes.
+
+A claim is first an in-progress lease of LEASE_SECONDS. It becomes a done
+marker (kept for TTL_SECONDS) once the message is processed, or is
+released on failure or cancellation. A process that dies mid-message only
+blocks that message until the lease runs out.
+"""
+import os
+import time
+import threading
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TTL_SECONDS = int(os.getenv("DEDUPE_TTL_SECONDS", "86400"))
+LEASE_SECONDS = int(os.getenv("DEDUPE_LEASE_SECONDS", "600"))
+MAX_ENTRIES = int(os.getenv("DEDUPE_MAX_ENTRIES", "100000"))
+REDIS_URL = os.getenv("DEDUPE_REDIS_URL")
+
+
+class DedupeStore:
+    """Remembers which messages have already been claimed for processing"""
+
+    def __init__(
+        self,
+        max_entries: int = MAX_ENTRIES,
+        ttl: int = TTL_SECONDS,
+        lease: int = LEASE_SECONDS,
+        redis_url: str = REDIS_URL
+    ):
+        self.ttl = ttl
+        self.lease = lease
+        # key -> lease deadline (time.monotonic) while in progress, None once done
+        self._seen = TTLCache(maxsize=max_entries, ttl=ttl)
+        self._lock = threading.Lock()
+        self._redis_url = redis_url
+        self._redis = None
+
+    @staticmethod
+    def _key(provider: str, user_id: str, message_id: str) -> str:
+        return f"dedupe:{provider}:{user_id}:{message_id}"
+
+    def _shared(self):
+        if self._redis is None and self._redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(self._redis_url)
+        return self._redis
+
+    def claim(self, provider: str, user_id: str, message_id: str) -> bool:
+        """
+        Returns True the first time a message is seen, False for duplicates
+        (done, or leased by a worker that is still processing it).
+        If the shared tier is unreachable, falls back to the local tier only.
+        """
+        key = self._key(provider, user_id, message_id)
+        now = time.monotonic()
+        with self._lock:
+            if key in self._seen:
+                deadline = self._seen[key]
+                if deadline is None or deadline > now:
+                    return False
+            self._seen[key] = now + self.lease
+
+        shared = self._shared()
+        if shared is not None:
+            try:
+                if not shared.set(key, "pending", nx=True, ex=self.lease):
+                    return False
+            except Exception as e:
+                print(f"Shared dedupe store unavailable: {e}")
+        return True
+
+    def complete(self, provider: str, user_id: str, message_id: str):
+        """Turn a claim into a done marker so redeliveries stay no-ops"""
+        key = self._key(provider, user_id, message_id)
+        with self._lock:
+            self._seen[key] = None
+
+        shared = self._shared()
+        if shared is not None:
+            try:
+                shared.set(key, "done", ex=self.ttl)
+            except Exception as e:
+                print(f"Shared dedupe store unavailable: {e}")
+
+    def is_done(self, provider: str, user_id: str, message_id: str) -> bool:
+        """Has the message been fully processed (here or on another worker)?"""
+        key = self._key(provider, user_id, message_id)
+        with self._lock:
+            if key in self._seen and self._seen[key] is None:
+                return True
+
+        shared = self._shared()
+        if shared is not None:
+            try:
+                return shared.get(key) == b"done"
+            except Exception as e:
+                print(f"Shared dedupe store unavailable: {e}")
+        return False
+
+    def release(self, provider: str, user_id: str, message_id: str):
+        """Forget a claim so a later redelivery is processed again"""
+        key = self._key(provider, user_id, message_id)
+        with self._lock:
+            self._seen.pop(key, None)
+
+        shared = self._shared()
+        if shared is not None:
+            try:
+                shared.delete(key)
+            except Exception as e:
+                print(f"Shared dedupe store unavailable: {e}")
+
+
+# Singleton instance
+dedupe_store = DedupeStore()
@@ -0,0 +1,90 @@
+"""
+Email job dispatch.
+Webhook handlers publish work here instead of running it directly. With
+EMAIL_QUEUE_BACKEND=inline (default) jobs run on the in-process work queue;
+with EMAIL_QUEUE_BACKEND=celery they are published to the Celery/Redis
+worker tier defined in worker.py.
+
+Celery spreads a mailbox's work over many processes, so the dedupe store
+must be shared (DEDUPE_REDIS_URL); check_config() refuses to start without
+it. Eager mode (CELERY_TASK_ALWAYS_EAGER=true) runs every task in the web
+process and is exempt, so local testing needs no Redis. The same goes for
+the inline backend served by several worker processes (WEB_CONCURRENCY,
+which uvicorn reads as its --workers default): without the shared tier
+each process would walk and answer the same mailbox history.
+"""
+import os
+from dotenv import load_dotenv
+from services.work_queue import work_queue
+
+load_dotenv()
+
+BACKEND = os.getenv("EMAIL_QUEUE_BACKEND", "inline")
+EAGER = os.getenv("CELERY_TASK_ALWAYS_EAGER", "false").lower() == "true"
+WEB_PROCESSES = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+
+def uses_celery() -> bool:
+    return BACKEND == "celery"
+
+
+def check_config():
+    """Fail fast on a queue setup that would process messages twice"""
+    if uses_celery() and not EAGER and not os.getenv("DEDUPE_REDIS_URL"):
+        raise RuntimeError(
+            "EMAIL_QUEUE_BACKEND=celery requires DEDUPE_REDIS_URL: per-process "
+            "dedupe would let several workers walk and reply to the same mail"
+        )
+    if not uses_celery() and WEB_PROCESSES > 1 and not os.getenv("DEDUPE_REDIS_URL"):
+        raise RuntimeError(
+            "EMAIL_QUEUE_BACKEND=inline with WEB_CONCURRENCY > 1 requires "
+            "DEDUPE_REDIS_URL: each process would walk and reply to the same mail"
+        )
+
+
+def submit_gmail_notification(user_id: str, history_id: str) -> bool:
+    if uses_celery():
+        from worker import process_gmail_history
+        process_gmail_history.delay(user_id, history_id)
+        return True
+
+    from handlers.gmail_webhook_handler import process_gmail_notification
+    return work_queue.submit(process_gmail_notification, user_id, history_id)
+
+
+def submit_outlook_notification(notification_data: dict, client_state: str) -> bool:
+    if uses_celery():
+        from worker import process_outlook_batch
+        process_outlook_batch.delay(notification_data, client_state)
+        return True
+
+    from handlers.outlook_webhook_handler import process_outlook_notification
+    return work_queue.submit(process_outlook_notification, notification_data, client_state)
+
+
+def submit_outlook_delta(user_id: str) -> bool:
+    """Catch an Outlook mailbox up through its delta query"""
+    if uses_celery():
+        from worker import sync_outlook_mailbox
+        sync_outlook_mailbox.delay(user_id)
+        return True
+
+    from handlers.outlook_webhook_handler import sync_outlook_delta
+    return work_queue.submit(sync_outlook_delta, user_id)
+
+
+def submit_gmail_thread(user_id: str, workspace_ids: list, message_ids: list):
+    """Messages of one thread travel as one job so they stay ordered"""
+    from worker import process_gmail_thread
+    process_gmail_thread.delay(user_id, list(workspace_ids), list(message_ids))
+
+
+def submit_outlook_message(user_id: str, workspace_ids: list, message_id: str):
+    from worker import process_outlook_message
+    process_outlook_message.delay(user_id, list(workspace_ids), message_id)
+
+
+def submit_reply(workspace_id: str, user_id: str, block_id: str, trigger_data: dict):
+    """Hand an action-reply-email block to the LLM worker queue"""
+    from worker import reply_email
+    reply_email.delay(workspace_id, user_id, block_id, trigger_data)
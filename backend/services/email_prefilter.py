@@ -0,0 +1,72 @@
+"""
+Deterministic pre-filter for reply decisions.
+Cheap header and label checks that settle the obvious automated-mail
+cases (the same rules the should_reply_to_email prompt lists) without an
+LLM round trip. Only undecided mail goes on to the LLM.
+"""
+import re
+from email.utils import parseaddr
+from typing import Optional
+
+# Headers the pre-filter looks at; the handlers only keep these in trigger_data
+HEADERS = (
+    "auto-submitted",
+    "list-id",
+    "list-unsubscribe",
+    "precedence",
+    "return-path",
+)
+
+NO_REPLY_LOCAL_PART = re.compile(
+    r"^(no[-_.]?reply|do[-_.]?not[-_.]?reply|mailer-daemon|postmaster|bounces?|notifications?)([+-].*)?$"
+)
+BULK_PRECEDENCE = {"bulk", "list", "junk"}
+AUTOMATED_LABELS = {"CATEGORY_PROMOTIONS", "CATEGORY_UPDATES"}
+
+
+def parse_address(value: str) -> str:
+    """'Jane <Jane@Example.com>' -> 'jane@example.com' (kept local so the pre-filter has no I/O imports)"""
+    return parseaddr(value or "")[1].strip().lower()
+
+
+def relevant_headers(headers) -> dict:
+    """
+    Reduce provider headers to the ones the pre-filter needs.
+    Accepts Gmail [{'name', 'value'}] lists and Graph internetMessageHeaders.
+    """
+    return {
+        h['name'].lower(): h['value']
+        for h in headers or []
+        if h.get('name', '').lower() in HEADERS
+    }
+
+
+def classify(sender: str, headers: dict = None, label_ids=None) -> Optional[str]:
+    """
+    Returns a 'NO - reason' string when the email is confidently automated,
+    or None when the decision should be left to the LLM.
+    """
+    headers = headers or {}
+
+    local_part = parse_address(sender).split("@")[0]
+    if NO_REPLY_LOCAL_PART.match(local_part):
+        return "NO - no-reply sender"
+
+    auto_submitted = headers.get("auto-submitted", "").strip().lower()
+    if auto_submitted and auto_submitted != "no":
+        return f"NO - Auto-Submitted: {auto_submitted}"
+
+    if headers.get("precedence", "").strip().lower() in BULK_PRECEDENCE:
+        return "NO - bulk/list precedence"
+
+    if headers.get("list-unsubscribe") or headers.get("list-id"):
+        return "NO - mailing list (List-Unsubscribe)"
+
+    if headers.get("return-path", "").strip() == "<>":
+        return "NO - bounce notification"
+
+    matched_labels = AUTOMATED_LABELS.intersection(label_ids or [])
+    if matched_labels:
+        return f"NO - Gmail {sorted(matched_labels)[0]}"
+
+    return None
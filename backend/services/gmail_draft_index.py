@@ -0,0 +1,72 @@
+"""
+Persistent Gmail thread -> draft index.
+Remembers the draft we last created in each thread so it can be replaced
+directly instead of scanning every draft in the mailbox. Backed by the
+gmail_thread_drafts table (unique on user_id, thread_id) with an in-memory
+LRU in front of it.
+"""
+import os
+import threading
+from typing import Optional
+from cachetools import LRUCache
+from supabase import create_client
+from dotenv import load_dotenv
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+CACHE_SIZE = int(os.getenv("GMAIL_DRAFT_INDEX_CACHE_SIZE", "10000"))
+
+
+class GmailDraftIndex:
+    """(user_id, thread_id) -> draft_id"""
+
+    def __init__(self, maxsize: int = CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._drafts = LRUCache(maxsize=maxsize)
+
+    def get(self, user_id: str, thread_id: str) -> Optional[str]:
+        with self._lock:
+            draft_id = self._drafts.get((user_id, thread_id))
+        if draft_id:
+            return draft_id
+
+        result = supabase.table("gmail_thread_drafts")\
+            .select("draft_id")\
+            .eq("user_id", user_id)\
+            .eq("thread_id", thread_id)\
+            .limit(1)\
+            .execute()
+        if not result.data:
+            return None
+
+        draft_id = result.data[0]['draft_id']
+        with self._lock:
+            self._drafts[(user_id, thread_id)] = draft_id
+        return draft_id
+
+    def put(self, user_id: str, thread_id: str, draft_id: str):
+        with self._lock:
+            self._drafts[(user_id, thread_id)] = draft_id
+        supabase.table("gmail_thread_drafts").upsert({
+            "user_id": user_id,
+            "thread_id": thread_id,
+            "draft_id": draft_id
+        }, on_conflict="user_id,thread_id").execute()
+
+    def forget(self, user_id: str, thread_id: str):
+        with self._lock:
+            self._drafts.pop((user_id, thread_id), None)
+        supabase.table("gmail_thread_drafts")\
+            .delete()\
+            .eq("user_id", user_id)\
+            .eq("thread_id", thread_id)\
+            .execute()
+
+
+# Singleton instance
+gmail_drafts = GmailDraftIndex()
@@ -0,0 +1,274 @@
+"""
+Per-user Gmail API clients with credential caching.
+Built service objects are kept in a bounded TTL cache so the email hot path
+doesn't re-read credentials or re-run discovery.build() on every call.
+Refreshes are single-flight per user, and a background task refreshes
+tokens shortly before they expire.
+"""
+import os
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+import httplib2
+from cachetools import TTLCache
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from supabase import create_client
+from dotenv import load_dotenv
+from services.cache_bus import cache_bus
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+GMAIL_SCOPES = [
+    'https://www.googleapis.com/auth/gmail.readonly',
+    'https://www.googleapis.com/auth/gmail.send',
+    'https://www.googleapis.com/auth/gmail.modify'
+]
+
+CACHE_SIZE = int(os.getenv("GMAIL_CLIENT_CACHE_SIZE", "512"))
+CACHE_TTL_SECONDS = int(os.getenv("GMAIL_CLIENT_CACHE_TTL", "3600"))
+# Background refresh kicks in this long before token_expiry
+REFRESH_MARGIN = timedelta(seconds=int(os.getenv("GMAIL_TOKEN_REFRESH_MARGIN", "300")))
+REFRESH_INTERVAL_SECONDS = int(os.getenv("GMAIL_TOKEN_REFRESH_INTERVAL", "60"))
+
+
+def _parse_expiry(value):
+    """Parse token_expiry into a naive UTC datetime (what google-auth uses)"""
+    if not value:
+        return None
+    expiry = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if expiry.tzinfo is not None:
+        expiry = expiry.astimezone(timezone.utc).replace(tzinfo=None)
+    return expiry
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class _CachedClient:
+    def __init__(self, creds: Credentials, service):
+        self.creds = creds
+        self.service = service
+
+
+class GmailClientCache:
+    """Bounded LRU/TTL cache of built Gmail services, keyed by user_id"""
+
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: int = CACHE_TTL_SECONDS):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._user_locks = {}
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        with self._lock:
+            lock = self._user_locks.get(user_id)
+            if lock is None:
+                lock = self._user_locks[user_id] = threading.Lock()
+            return lock
+
+    def _cached(self, user_id: str):
+        with self._lock:
+            return self._entries.get(user_id)
+
+    def invalidate(self, user_id: str):
+        """Drop a user's client (e.g. after re-authentication)"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def ready_service(self, user_id: str):
+        """The cached service if its token is still valid, else None (never blocks)"""
+        entry = self._cached(user_id)
+        return entry.service if entry and entry.creds.valid else None
+
+    def get_service(self, user_id: str, force_refresh: bool = False):
+        return self._entry(user_id, force_refresh).service
+
+    def credentials(self, user_id: str) -> Credentials:
+        """The user's current credentials, refreshed if needed"""
+        return self._entry(user_id).creds
+
+    def _entry(self, user_id: str, force_refresh: bool = False) -> _CachedClient:
+        entry = self._cached(user_id)
+        if entry and not force_refresh and entry.creds.valid:
+            return entry
+
+        # Single-flight: whoever holds the lock loads/refreshes, everyone else reuses it
+        with self._user_lock(user_id):
+            entry = self._cached(user_id)
+            if entry is None:
+                entry = self._load(user_id)
+                force_refresh = force_refresh or not entry.creds.valid
+            elif entry.creds.valid and not force_refresh:
+                return entry
+
+            if force_refresh or not entry.creds.valid:
+                self._refresh(user_id, entry.creds)
+
+            with self._lock:
+                self._entries[user_id] = entry
+            return entry
+
+    def _load(self, user_id: str) -> _CachedClient:
+        result = supabase.table("user_oauth_credentials")\
+            .select("*")\
+            .eq("user_id", user_id)\
+            .eq("provider", "gmail")\
+            .single()\
+            .execute()
+
+        if not result.data:
+            raise Exception(f"No Gmail credentials found for user {user_id}. Please reconnect Gmail.")
+
+        creds_data = result.data
+
+        # Check if refresh token exists
+        if not creds_data.get('refresh_token'):
+            raise Exception(f"No refresh token found for user {user_id}. User needs to re-authenticate with Gmail.")
+
+        creds = Credentials(
+            token=creds_data['access_token'],
+            refresh_token=creds_data['refresh_token'],
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=os.getenv("GOOGLE_CLIENT_ID"),
+            client_secret=os.getenv("GOOGLE_CLIENT_SECRET"),
+            scopes=GMAIL_SCOPES
+        )
+        try:
+            creds.expiry = _parse_expiry(creds_data.get('token_expiry'))
+        except ValueError:
+            creds.expiry = _utcnow()
+
+        return _CachedClient(creds, build('gmail', 'v1', credentials=creds, cache_discovery=False))
+
+    def _refresh(self, user_id: str, creds: Credentials):
+        print(f"Refreshing Gmail token for user {user_id}...")
+        try:
+            creds.refresh(Request())
+
+            # Update stored token
+            supabase.table("user_oauth_credentials").update({
+                "access_token": creds.token,
+                "token_expiry": creds.expiry.isoformat() if creds.expiry else None
+            }).eq("user_id", user_id).eq("provider", "gmail").execute()
+
+            print(f"Token refreshed successfully for user {user_id}")
+        except Exception as refresh_error:
+            self.invalidate(user_id)
+            print(f"Token refresh failed: {refresh_error}")
+            raise Exception(
+                f"Failed to refresh Gmail token for user {user_id}. "
+                f"User needs to reconnect their Gmail account. "
+                f"Error: {str(refresh_error)}"
+            )
+
+    def _refresh_if_expiring(self, user_id: str):
+        with self._user_lock(user_id):
+            entry = self._cached(user_id)
+            if entry is None:
+                return
+            expiry = entry.creds.expiry
+            if expiry is None or expiry - REFRESH_MARGIN <= _utcnow():
+                self._refresh(user_id, entry.creds)
+
+    def expiring_users(self) -> list:
+        deadline = _utcnow() + REFRESH_MARGIN
+        with self._lock:
+            return [
+                user_id for user_id, entry in self._entries.items()
+                if entry.creds.expiry is None or entry.creds.expiry <= deadline
+            ]
+
+    async def refresh_expiring(self):
+        """Refresh every cached token that is about to expire"""
+        loop = asyncio.get_running_loop()
+        for user_id in self.expiring_users():
+            try:
+                await loop.run_in_executor(None, self._refresh_if_expiring, user_id)
+            except Exception as e:
+                print(f"Background Gmail token refresh failed for user {user_id}: {e}")
+
+    async def run_refresher(self, interval: int = REFRESH_INTERVAL_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            await self.refresh_expiring()
+
+
+# Singleton instance
+gmail_clients = GmailClientCache()
+
+
+def _on_credentials_change(row: dict):
+    if row.get('user_id') and row.get('provider', 'gmail') == 'gmail':
+        gmail_clients.invalidate(row['user_id'])
+
+
+def _on_credentials_update(row: dict):
+    # Token refreshes (ours included) rewrite access_token on every refresh;
+    # only a re-authorization (new refresh token) makes the cached client stale
+    if not row.get('user_id') or row.get('provider', 'gmail') != 'gmail':
+        return
+    entry = gmail_clients._cached(row['user_id'])
+    if entry and row.get('refresh_token') and entry.creds.refresh_token == row['refresh_token']:
+        return
+    gmail_clients.invalidate(row['user_id'])
+
+
+cache_bus.subscribe("user_oauth_credentials", _on_credentials_change, events=("INSERT", "DELETE"))
+cache_bus.subscribe("user_oauth_credentials", _on_credentials_update, events=("UPDATE",))
+
+
+def get_user_gmail_service(user_id: str, force_refresh: bool = False):
+    """
+    Get Gmail service for specific user with automatic token refresh.
+
+    Args:
+        user_id: User ID
+        force_refresh: If True, force token refresh even if not expired
+    """
+    return gmail_clients.get_service(user_id, force_refresh=force_refresh)
+
+
+async def get_user_gmail_service_async(user_id: str):
+    """
+    get_user_gmail_service() for the event loop: a cache hit returns
+    directly, a miss (DB load, build(), token refresh) runs in a thread
+    """
+    service = gmail_clients.ready_service(user_id)
+    if service is not None:
+        return service
+    return await asyncio.to_thread(gmail_clients.get_service, user_id)
+
+
+_thread_transports = threading.local()
+
+
+def _thread_http() -> httplib2.Http:
+    """This thread's own keep-alive transport, reused across calls and users"""
+    http = getattr(_thread_transports, "http", None)
+    if http is None:
+        http = _thread_transports.http = httplib2.Http()
+    return http
+
+
+def execute_isolated(user_id: str, request, **kwargs):
+    """
+    Execute a googleapiclient request (or batch) on the calling thread's
+    transport, authorized with the user's shared credentials. The cached
+    service's httplib2 transport is not thread-safe, so any call made off
+    the event loop thread must go through here.
+    """
+    http = AuthorizedHttp(gmail_clients.credentials(user_id), http=_thread_http())
+    return request.execute(http=http, **kwargs)
+
+
+async def execute_async(user_id: str, request, **kwargs):
+    """execute_isolated() in a worker thread, so the event loop isn't blocked"""
+    return await asyncio.to_thread(execute_isolated, user_id, request, **kwargs)
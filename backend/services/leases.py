@@ -0,0 +1,101 @@
+"""
+Cluster-wide leases for jobs that must run on one node at a time, such as
+the startup Outlook catch-up, watch renewal and a mailbox's Gmail history
+walk. Backed by the shared Redis tier (DEDUPE_REDIS_URL). Without it no
+lease can be taken; callers check `available` and then fall back to
+their own per-node switch.
+
+Flags let a node that finds a lease taken ask the holder to run its job
+once more before letting go.
+"""
+import os
+import uuid
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv("DEDUPE_REDIS_URL")
+
+# Delete the lease only if this process still holds it
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseStore:
+    """name -> holder token, expiring after the lease's ttl"""
+
+    def __init__(self, redis_url: str = REDIS_URL):
+        self._redis_url = redis_url
+        self._redis = None
+        self._token = uuid.uuid4().hex
+
+    @property
+    def available(self) -> bool:
+        return bool(self._redis_url)
+
+    def _shared(self):
+        if self._redis is None and self._redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(self._redis_url)
+        return self._redis
+
+    def try_acquire(self, name: str, ttl: int, fail_open: bool = False) -> bool:
+        """
+        Take (or extend, if we already hold it) the lease; False if another node holds it.
+
+        Args:
+            fail_open: report the lease as taken when Redis can't be reached
+                (for jobs where running twice beats not running)
+        """
+        shared = self._shared()
+        if shared is None:
+            return False
+        key = f"lease:{name}"
+        try:
+            if shared.set(key, self._token, nx=True, ex=ttl):
+                return True
+            if shared.get(key) == self._token.encode():
+                shared.expire(key, ttl)
+                return True
+            return False
+        except Exception as e:
+            print(f"Lease store unavailable, {'taking' if fail_open else 'not taking'} {name}: {e}")
+            return fail_open
+
+    def release(self, name: str):
+        """Give up the lease early (no-op if another node holds it)"""
+        shared = self._shared()
+        if shared is None:
+            return
+        try:
+            shared.eval(RELEASE_SCRIPT, 1, f"lease:{name}", self._token)
+        except Exception as e:
+            print(f"Lease store unavailable, {name} expires on its own: {e}")
+
+    def set_flag(self, name: str, ttl: int):
+        shared = self._shared()
+        if shared is None:
+            return
+        try:
+            shared.set(f"flag:{name}", 1, ex=ttl)
+        except Exception as e:
+            print(f"Lease store unavailable, not flagging {name}: {e}")
+
+    def take_flag(self, name: str) -> bool:
+        """Clear the flag; True if it was set"""
+        shared = self._shared()
+        if shared is None:
+            return False
+        try:
+            return bool(shared.delete(f"flag:{name}"))
+        except Exception as e:
+            print(f"Lease store unavailable, not reading {name}: {e}")
+            return False
+
+
+# Singleton instance
+leases = LeaseStore()
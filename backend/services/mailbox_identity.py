@@ -0,0 +1,90 @@
+"""
+Mailbox identity cache used by the self-sent loop check.
+The connected address is written to user_oauth_credentials.email by the
+OAuth callbacks; it is read once per (user, provider) and kept in memory.
+When the column is empty the provider is asked once and the column is
+backfilled.
+"""
+import os
+import inspect
+import threading
+from email.utils import parseaddr
+from supabase import create_client
+from dotenv import load_dotenv
+from services.cache_bus import cache_bus
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+
+def parse_address(value: str) -> str:
+    """'Jane <Jane@Example.com>' -> 'jane@example.com'"""
+    return parseaddr(value or "")[1].strip().lower()
+
+
+def is_self_sent(from_header: str, mailbox_address: str) -> bool:
+    sender = parse_address(from_header)
+    return bool(sender) and sender == parse_address(mailbox_address)
+
+
+class MailboxIdentityCache:
+    """(user_id, provider) -> mailbox address"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._addresses = {}
+
+    async def get(self, user_id: str, provider: str, lookup=None) -> str:
+        """
+        Args:
+            lookup: fallback returning the address from the provider
+                    (sync or async), used only when the column is empty
+        """
+        address = self._addresses.get((user_id, provider))
+        if address:
+            return address
+
+        result = supabase.table("user_oauth_credentials")\
+            .select("email")\
+            .eq("user_id", user_id)\
+            .eq("provider", provider)\
+            .limit(1)\
+            .execute()
+        address = parse_address(result.data[0].get('email')) if result.data else ""
+
+        if not address and lookup is not None:
+            address = lookup()
+            if inspect.isawaitable(address):
+                address = await address
+            address = parse_address(address)
+            if address:
+                supabase.table("user_oauth_credentials").update({
+                    "email": address
+                }).eq("user_id", user_id).eq("provider", provider).execute()
+
+        if address:
+            with self._lock:
+                self._addresses[(user_id, provider)] = address
+        return address
+
+    def invalidate(self, user_id: str, provider: str = None):
+        with self._lock:
+            for key in list(self._addresses):
+                if key[0] == user_id and (provider is None or key[1] == provider):
+                    del self._addresses[key]
+
+
+# Singleton instance
+mailbox_identities = MailboxIdentityCache()
+
+
+def _on_credentials_change(row: dict):
+    if row.get('user_id'):
+        mailbox_identities.invalidate(row['user_id'], row.get('provider'))
+
+
+cache_bus.subscribe("user_oauth_credentials", _on_credentials_change)
@@ -0,0 +1,225 @@
+"""
+Mailbox routing index: maps inbound notifications to every
+(user_id, workspace_id) attached to the mailbox.
+Gmail notifications are routed by mailbox address, Outlook notifications
+by Graph subscription id (shared by all of a mailbox's workspaces).
+Loaded once at startup, kept current by the watch setup/teardown functions
+and by row changes from the cache bus. Routine updates (history cursor,
+expiration, token refresh) leave the routes alone; only changes to the
+mailbox, its workspaces or its subscription evict them.
+"""
+import os
+import threading
+from typing import NamedTuple
+from supabase import create_client
+from dotenv import load_dotenv
+from services.cache_bus import cache_bus
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+PAGE_SIZE = int(os.getenv("MAILBOX_ROUTER_PAGE_SIZE", "1000"))
+
+
+class MailboxRoute(NamedTuple):
+    user_id: str
+    workspace_id: str
+
+
+def normalize_address(address: str) -> str:
+    return (address or "").strip().lower()
+
+
+def _fetch_all(table: str, columns: str, order: str, **filters) -> list:
+    """Read a whole table in PAGE_SIZE chunks, ordered by a unique key so pages don't overlap"""
+    rows = []
+    start = 0
+    while True:
+        query = supabase.table(table).select(columns)
+        for column, value in filters.items():
+            query = query.eq(column, value)
+        for column in order.split(","):
+            query = query.order(column)
+        page = query.range(start, start + PAGE_SIZE - 1).execute()
+        rows.extend(page.data or [])
+        if not page.data or len(page.data) < PAGE_SIZE:
+            return rows
+        start += PAGE_SIZE
+
+
+def _with_route(routes: tuple, route: MailboxRoute) -> tuple:
+    return routes if route in routes else routes + (route,)
+
+
+class MailboxRouter:
+    """In-memory index of active watches"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gmail = {}    # mailbox address -> (MailboxRoute, ...)
+        self._outlook = {}  # subscription id -> (MailboxRoute, ...)
+
+    def load(self):
+        """Populate the index from gmail_watches / outlook_watches"""
+        gmail_addresses = {
+            cred['user_id']: normalize_address(cred.get('email'))
+            for cred in _fetch_all("user_oauth_credentials", "user_id, email", "user_id", provider="gmail")
+        }
+        gmail = {}
+        for watch in _fetch_all("gmail_watches", "user_id, workspace_id", "user_id,workspace_id"):
+            address = gmail_addresses.get(watch['user_id'])
+            if address:
+                route = MailboxRoute(watch['user_id'], watch['workspace_id'])
+                gmail[address] = _with_route(gmail.get(address, ()), route)
+
+        outlook = {}
+        for watch in _fetch_all("outlook_watches", "user_id, workspace_id, subscription_id", "user_id,workspace_id"):
+            if watch.get('subscription_id'):
+                route = MailboxRoute(watch['user_id'], watch['workspace_id'])
+                outlook[watch['subscription_id']] = _with_route(outlook.get(watch['subscription_id'], ()), route)
+
+        with self._lock:
+            self._gmail = gmail
+            self._outlook = outlook
+
+        print(f"Mailbox router loaded: {len(gmail)} Gmail, {len(outlook)} Outlook routes")
+
+    # Gmail
+
+    def add_gmail(self, address: str, user_id: str, workspace_id: str):
+        address = normalize_address(address)
+        if not address:
+            return
+        with self._lock:
+            self._gmail[address] = _with_route(self._gmail.get(address, ()), MailboxRoute(user_id, workspace_id))
+
+    def remove_gmail(self, user_id: str, workspace_id: str):
+        with self._lock:
+            for address, routes in list(self._gmail.items()):
+                remaining = tuple(r for r in routes if r != (user_id, workspace_id))
+                if remaining:
+                    self._gmail[address] = remaining
+                else:
+                    del self._gmail[address]
+
+    def evict_gmail_user(self, user_id: str):
+        """Forget a user's mailbox; the next lookup re-resolves it from the database"""
+        with self._lock:
+            for address, routes in list(self._gmail.items()):
+                if routes[0].user_id == user_id:
+                    del self._gmail[address]
+
+    def has_gmail(self, address: str, user_id: str) -> bool:
+        """Is this address already routed to user_id?"""
+        routes = self._gmail.get(normalize_address(address), ())
+        return bool(routes) and routes[0].user_id == user_id
+
+    def lookup_gmail(self, address: str) -> tuple:
+        """
+        Resolve a Pub/Sub emailAddress to all routes of that mailbox.
+        Falls back to the database on a miss (e.g. watch created on another node).
+        """
+        address = normalize_address(address)
+        routes = self._gmail.get(address, ())
+        if routes or not address:
+            return routes
+
+        creds = supabase.table("user_oauth_credentials")\
+            .select("user_id")\
+            .eq("provider", "gmail")\
+            .eq("email", address)\
+            .limit(1)\
+            .execute()
+        if not creds.data:
+            return ()
+
+        user_id = creds.data[0]['user_id']
+        watches = supabase.table("gmail_watches")\
+            .select("workspace_id")\
+            .eq("user_id", user_id)\
+            .execute()
+
+        for watch in watches.data or []:
+            self.add_gmail(address, user_id, watch['workspace_id'])
+        return self._gmail.get(address, ())
+
+    # Outlook
+
+    def add_outlook(self, subscription_id: str, user_id: str, workspace_id: str):
+        with self._lock:
+            routes = self._outlook.get(subscription_id, ())
+            self._outlook[subscription_id] = _with_route(routes, MailboxRoute(user_id, workspace_id))
+
+    def remove_outlook(self, user_id: str, workspace_id: str):
+        with self._lock:
+            for subscription_id, routes in list(self._outlook.items()):
+                remaining = tuple(r for r in routes if r != (user_id, workspace_id))
+                if remaining:
+                    self._outlook[subscription_id] = remaining
+                else:
+                    del self._outlook[subscription_id]
+
+    def evict_outlook(self, subscription_id: str = None, user_id: str = None):
+        with self._lock:
+            for key, routes in list(self._outlook.items()):
+                if key == subscription_id or routes[0].user_id == user_id:
+                    del self._outlook[key]
+
+    def has_outlook(self, subscription_id: str, user_id: str, workspace_id: str) -> bool:
+        return (user_id, workspace_id) in self._outlook.get(subscription_id, ())
+
+    def lookup_outlook(self, subscription_id: str) -> tuple:
+        """All routes sharing a Graph subscription"""
+        routes = self._outlook.get(subscription_id, ())
+        if routes or not subscription_id:
+            return routes
+
+        watches = supabase.table("outlook_watches")\
+            .select("user_id, workspace_id")\
+            .eq("subscription_id", subscription_id)\
+            .execute()
+
+        for watch in watches.data or []:
+            self.add_outlook(subscription_id, watch['user_id'], watch['workspace_id'])
+        return self._outlook.get(subscription_id, ())
+
+
+# Singleton instance
+mailbox_router = MailboxRouter()
+
+
+def _on_gmail_change(row: dict):
+    if row.get('user_id') and row.get('provider', 'gmail') == 'gmail':
+        mailbox_router.evict_gmail_user(row['user_id'])
+
+
+def _on_gmail_credentials_update(row: dict):
+    # Token refreshes update this row constantly; only a new address matters
+    if row.get('provider', 'gmail') != 'gmail' or not row.get('user_id'):
+        return
+    if row.get('email') and mailbox_router.has_gmail(row['email'], row['user_id']):
+        return
+    mailbox_router.evict_gmail_user(row['user_id'])
+
+
+def _on_outlook_watch_change(row: dict):
+    mailbox_router.evict_outlook(row.get('subscription_id'), row.get('user_id'))
+
+
+def _on_outlook_watch_update(row: dict):
+    # Renewals only move the expiration; a moved subscription must re-route
+    if mailbox_router.has_outlook(row.get('subscription_id'), row.get('user_id'), row.get('workspace_id')):
+        return
+    _on_outlook_watch_change(row)
+
+
+# gmail_watches updates only move history_id / expiration
+cache_bus.subscribe("gmail_watches", _on_gmail_change, events=("INSERT", "DELETE"))
+cache_bus.subscribe("user_oauth_credentials", _on_gmail_change, events=("INSERT", "DELETE"))
+cache_bus.subscribe("user_oauth_credentials", _on_gmail_credentials_update, events=("UPDATE",))
+cache_bus.subscribe("outlook_watches", _on_outlook_watch_change, events=("INSERT", "DELETE"))
+cache_bus.subscribe("outlook_watches", _on_outlook_watch_update, events=("UPDATE",))
@@ -1,6 +1,6 @@
 #services/outlook_service.py
 import os
-import requests
+import httpx
 from datetime import datetime, timedelta, timezone
 from supabase import create_client
 from dotenv import load_dotenv
@@ -12,14 +12,43 @@ supabase = create_client(
     os.getenv("SUPABASE_KEY")
 )
 
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+TOKEN_URL = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
+# Graph JSON batching accepts at most 20 requests per $batch call
+GRAPH_BATCH_LIMIT = 20
+DELTA_PAGE_SIZE = int(os.getenv("GRAPH_DELTA_PAGE_SIZE", "50"))
+
+# Default per-call timeout; individual calls can pass timeout=...
+DEFAULT_TIMEOUT = httpx.Timeout(float(os.getenv("GRAPH_TIMEOUT_SECONDS", "15")), connect=5.0)
+CONNECTION_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("GRAPH_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("GRAPH_MAX_KEEPALIVE_CONNECTIONS", "20"))
+)
+
+_http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared, pooled HTTP/2 client for all Graph and token calls"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(http2=True, timeout=DEFAULT_TIMEOUT, limits=CONNECTION_LIMITS)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
 class OutlookService:
     def __init__(self, user_id: str):
         self.user_id = user_id
         self.access_token = None
-        self._refresh_token_if_needed()
     
-    def _refresh_token_if_needed(self):
-        """Get access token and refresh if expired"""
+    def _load_credentials(self) -> dict:
         result = supabase.table("user_oauth_credentials")\
             .select("*")\
             .eq("user_id", self.user_id)\
@@ -30,7 +59,31 @@ class OutlookService:
         if not result.data:
             raise Exception(f"No Outlook credentials found for user {self.user_id}")
         
-        creds = result.data
+        return result.data
+    
+    async def _request_new_token(self, creds: dict) -> httpx.Response:
+        return await get_http_client().post(TOKEN_URL, data={
+            'client_id': os.getenv("MICROSOFT_CLIENT_ID"),
+            'client_secret': os.getenv("MICROSOFT_CLIENT_SECRET"),
+            'refresh_token': creds['refresh_token'],
+            'grant_type': 'refresh_token',
+            'scope': creds['scope']
+        })
+    
+    def _store_tokens(self, tokens: dict, creds: dict):
+        # Update database with timezone-aware datetime
+        new_expiry = datetime.now(timezone.utc) + timedelta(seconds=tokens['expires_in'])
+        supabase.table("user_oauth_credentials").update({
+            "access_token": tokens['access_token'],
+            "token_expiry": new_expiry.isoformat(),
+            "refresh_token": tokens.get('refresh_token', creds['refresh_token'])
+        }).eq("user_id", self.user_id).eq("provider", "outlook").execute()
+        
+        self.access_token = tokens['access_token']
+    
+    async def _refresh_token_if_needed(self):
+        """Get access token and refresh if expired"""
+        creds = self._load_credentials()
         expiry = datetime.fromisoformat(creds['token_expiry'])
         
         # Make expiry timezone-aware if it isn't already
@@ -42,35 +95,16 @@ class OutlookService:
         if expiry < now_utc + timedelta(minutes=5):
             print(f"Refreshing Outlook token for user {self.user_id}...")
             
-            token_url = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
-            token_data = {
-                'client_id': os.getenv("MICROSOFT_CLIENT_ID"),
-                'client_secret': os.getenv("MICROSOFT_CLIENT_SECRET"),
-                'refresh_token': creds['refresh_token'],
-                'grant_type': 'refresh_token',
-                'scope': creds['scope']
-            }
-            
-            response = requests.post(token_url, data=token_data)
+            response = await self._request_new_token(creds)
             response.raise_for_status()
-            tokens = response.json()
-            
-            # Update database with timezone-aware datetime
-            new_expiry = datetime.now(timezone.utc) + timedelta(seconds=tokens['expires_in'])
-            supabase.table("user_oauth_credentials").update({
-                "access_token": tokens['access_token'],
-                "token_expiry": new_expiry.isoformat(),
-                "refresh_token": tokens.get('refresh_token', creds['refresh_token'])
-            }).eq("user_id", self.user_id).eq("provider", "outlook").execute()
-            
-            self.access_token = tokens['access_token']
+            self._store_tokens(response.json(), creds)
             print(f"Outlook token refreshed")
         else:
             self.access_token = creds['access_token']
     
-    def _make_request(self, method: str, endpoint: str, **kwargs):
-        """Make authenticated request to Microsoft Graph API"""
-        url = f"https://graph.microsoft.com/v1.0{endpoint}"
+    async def _make_request(self, method: str, endpoint: str, **kwargs):
+        """Make authenticated request to Microsoft Graph API (endpoint or absolute nextLink/deltaLink)"""
+        url = endpoint if endpoint.startswith('https://') else f"{GRAPH_BASE_URL}{endpoint}"
         headers = {
             'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json'
@@ -79,42 +113,25 @@ class OutlookService:
         if 'headers' in kwargs:
             headers.update(kwargs.pop('headers'))
         
-        response = requests.request(method, url, headers=headers, **kwargs)
+        client = get_http_client()
+        response = await client.request(method, url, headers=headers, **kwargs)
         
         if response.status_code == 401:
             print(f"Got 401, forcing token refresh...")
-            token_url = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
-            
-            creds_result = supabase.table("user_oauth_credentials")\
-                .select("*").eq("user_id", self.user_id).eq("provider", "outlook").single().execute()
-            creds = creds_result.data
-            
-            token_response = requests.post(token_url, data={
-                'client_id': os.getenv("MICROSOFT_CLIENT_ID"),
-                'client_secret': os.getenv("MICROSOFT_CLIENT_SECRET"),
-                'refresh_token': creds['refresh_token'],
-                'grant_type': 'refresh_token',
-                'scope': creds['scope']
-            })
+            creds = self._load_credentials()
+            token_response = await self._request_new_token(creds)
             
-            if token_response.ok:
-                tokens = token_response.json()
-                new_expiry = datetime.now(timezone.utc) + timedelta(seconds=tokens['expires_in'])
-                supabase.table("user_oauth_credentials").update({
-                    "access_token": tokens['access_token'],
-                    "refresh_token": tokens.get('refresh_token', creds['refresh_token']),
-                    "token_expiry": new_expiry.isoformat()
-                }).eq("user_id", self.user_id).eq("provider", "outlook").execute()
-                self.access_token = tokens['access_token']
+            if token_response.is_success:
+                self._store_tokens(token_response.json(), creds)
                 print(f"Token force-refreshed")
                 headers['Authorization'] = f'Bearer {self.access_token}'
-                response = requests.request(method, url, headers=headers, **kwargs)
+                response = await client.request(method, url, headers=headers, **kwargs)
             else:
                 print(f"Token refresh failed: {token_response.text}")
                 response.raise_for_status()  # raise the original 401 explicitly
-
+        
         # THEN after the if block, do the error checking:
-        if not response.ok:
+        if not response.is_success:
             print(f"   Microsoft Graph API Error:")
             print(f"   Status: {response.status_code}")
             print(f"   URL: {url}")
@@ -125,77 +142,171 @@ class OutlookService:
                 print(f"   Error Details: {error_json}")
             except:
                 pass
-
+        
         response.raise_for_status()
         return response.json() if response.text else {}
     
-    def get_user_email(self):
+    async def get_user_email(self):
         """Get user's email address"""
-        result = self._make_request('GET', '/me')
+        result = await self._make_request('GET', '/me')
         return result.get('mail') or result.get('userPrincipalName')
     
-    def get_message(self, message_id: str):
-        """Get a specific message"""
-        return self._make_request('GET', f'/me/messages/{message_id}')
+    async def get_message(self, message_id: str, select: str = None):
+        """Get a specific message, optionally limited to a $select projection"""
+        params = {'$select': select} if select else None
+        return await self._make_request('GET', f'/me/messages/{message_id}', params=params)
     
-    def create_draft_reply(self, message_id: str, body: str):
-        """Create a draft reply to a message"""
+    async def inbox_delta(self, delta_link: str = None, select: str = None, received_since: datetime = None):
+        """
+        Page through inbox changes with a delta query.
+        Without a delta_link a new delta round starts; received_since bounds
+        it to recent mail so the first sync doesn't enumerate the whole inbox.
         
-        # First, create the reply
-        reply_draft = self._make_request('POST', f'/me/messages/{message_id}/createReply')
+        Yields:
+            (messages, delta_link) per page; delta_link is None until the last page
+        """
+        headers = {'Prefer': f'odata.maxpagesize={DELTA_PAGE_SIZE}'}
+        if delta_link:
+            url, params = delta_link, None
+        else:
+            url, params = '/me/mailFolders/inbox/messages/delta', {}
+            if select:
+                params['$select'] = select
+            if received_since:
+                params['$filter'] = f"receivedDateTime ge {received_since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
         
-        draft_id = reply_draft['id']
+        while url:
+            page = await self._make_request('GET', url, params=params, headers=headers)
+            params = None  # nextLink / deltaLink already carry the query
+            url = page.get('@odata.nextLink')
+            yield page.get('value', []), page.get('@odata.deltaLink')
+    
+    async def batch(self, requests: list) -> dict:
+        """
+        Run Graph requests through JSON $batch, GRAPH_BATCH_LIMIT per call.
         
-        # Update the draft with our content
-        update_data = {
-            'body': {
-                'contentType': 'Text',
-                'content': body
+        Each request is {'id', 'method', 'url', 'body'?, 'dependsOn'?} with a
+        URL relative to /v1.0. Requests linked by dependsOn must land in the
+        same chunk of GRAPH_BATCH_LIMIT.
+        
+        Returns:
+            {request_id: {'status': int, 'body': dict}}
+        """
+        responses = {}
+        for start in range(0, len(requests), GRAPH_BATCH_LIMIT):
+            chunk = []
+            for request in requests[start:start + GRAPH_BATCH_LIMIT]:
+                request = dict(request)
+                if 'body' in request:
+                    request.setdefault('headers', {'Content-Type': 'application/json'})
+                chunk.append(request)
+            
+            result = await self._make_request('POST', '/$batch', json={'requests': chunk})
+            for response in result.get('responses', []):
+                responses[response['id']] = response
+        return responses
+    
+    @staticmethod
+    def _reply_draft_body(body: str) -> dict:
+        # createReply accepts the draft's body directly, no follow-up PATCH needed
+        return {
+            'message': {
+                'body': {
+                    'contentType': 'Text',
+                    'content': body
+                }
             }
         }
+    
+    async def create_draft_reply(self, message_id: str, body: str):
+        """Create a draft reply to a message"""
+        reply_draft = await self._make_request(
+            'POST', f'/me/messages/{message_id}/createReply', json=self._reply_draft_body(body)
+        )
         
-        self._make_request('PATCH', f'/me/messages/{draft_id}', json=update_data)
+        draft_id = reply_draft['id']
         
         print(f"Draft reply created: {draft_id}")
         return {'id': draft_id}
     
-    def send_reply(self, message_id: str, body: str):
+    async def replace_draft_reply(self, conversation_id: str, message_id: str, body: str):
+        """
+        Delete the conversation's existing drafts and create the new reply draft
+        in a single $batch (plus one lookup of the existing drafts).
+        """
+        drafts = await self._list_conversation_drafts(conversation_id)
+        if not drafts:
+            return await self.create_draft_reply(message_id, body)
+        
+        print(f"🗑️  Replacing {len(drafts)} draft(s) in conversation {conversation_id}")
+        
+        requests = [
+            {'id': f'delete-{n}', 'method': 'DELETE', 'url': f'/me/messages/{draft_id}'}
+            for n, draft_id in enumerate(drafts)
+        ]
+        requests.append({
+            'id': 'reply',
+            'method': 'POST',
+            'url': f'/me/messages/{message_id}/createReply',
+            'body': self._reply_draft_body(body)
+        })
+        
+        responses = await self.batch(requests)
+        
+        for n, draft_id in enumerate(drafts):
+            status = responses.get(f'delete-{n}', {}).get('status')
+            if status not in (204, 404):
+                print(f"Could not delete draft {draft_id}: status {status}")
+        
+        reply = responses.get('reply', {})
+        if reply.get('status') not in (200, 201):
+            raise Exception(f"Failed to create Outlook draft reply: {reply.get('body')}")
+        
+        draft_id = reply['body']['id']
+        print(f"Draft reply created: {draft_id}")
+        return {'id': draft_id}
+    
+    async def send_reply(self, message_id: str, body: str):
         """Send a reply to a message immediately"""
         
         reply_data = {
             'comment': body  # Microsoft Graph uses 'comment' for reply body
         }
         
-        self._make_request('POST', f'/me/messages/{message_id}/reply', json=reply_data)
+        await self._make_request('POST', f'/me/messages/{message_id}/reply', json=reply_data)
         
         print(f"Reply sent to message {message_id}")
         return {'sent': True}
     
-    def delete_drafts_in_conversation(self, conversation_id: str):
+    async def _list_conversation_drafts(self, conversation_id: str) -> list:
+        params = {
+            '$filter': f"conversationId eq '{conversation_id}' and isDraft eq true",
+            '$select': 'id'
+        }
+        result = await self._make_request('GET', '/me/messages', params=params)
+        return [draft['id'] for draft in result.get('value', [])]
+    
+    async def delete_drafts_in_conversation(self, conversation_id: str):
         """
         Delete all draft replies in a conversation
         This prevents multiple drafts from piling up
         """
         try:
-            # Get all messages in conversation
-            params = {
-                '$filter': f"conversationId eq '{conversation_id}' and isDraft eq true",
-                '$select': 'id,isDraft'
-            }
-            
-            result = self._make_request('GET', '/me/messages', params=params)
-            
-            drafts = result.get('value', [])
+            drafts = await self._list_conversation_drafts(conversation_id)
             
             if drafts:
                 print(f"🗑️  Found {len(drafts)} draft(s) in conversation {conversation_id}")
                 
-                for draft in drafts:
-                    try:
-                        self._make_request('DELETE', f'/me/messages/{draft["id"]}')
-                        print(f"Deleted draft {draft['id']}")
-                    except Exception as e:
-                        print(f"Could not delete draft: {e}")
+                responses = await self.batch([
+                    {'id': str(n), 'method': 'DELETE', 'url': f'/me/messages/{draft_id}'}
+                    for n, draft_id in enumerate(drafts)
+                ])
+                for n, draft_id in enumerate(drafts):
+                    status = responses.get(str(n), {}).get('status')
+                    if status == 204:
+                        print(f"Deleted draft {draft_id}")
+                    else:
+                        print(f"Could not delete draft {draft_id}: status {status}")
             else:
                 print(f"No existing drafts in conversation")
         
@@ -203,5 +314,7 @@ class OutlookService:
             print(f"Error checking for drafts: {e}")
 
 # Helper function to get service
-def get_outlook_service(user_id: str) -> OutlookService:
-    return OutlookService(user_id)
\ No newline at end of file
+async def get_outlook_service(user_id: str) -> OutlookService:
+    service = OutlookService(user_id)
+    await service._refresh_token_if_needed()
+    return service
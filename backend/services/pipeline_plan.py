@@ -0,0 +1,145 @@
+"""
+Compiled workspace pipeline plans.
+A plan is an immutable snapshot of a workspace's ordered blocks with their
+configs already attached, so triggering a workflow needs no config reads.
+Plans are compiled at launch, cached in memory, and rebuilt when a block
+config changes. The frontend writes block configs straight to Supabase,
+so plans also expire after PLAN_TTL_SECONDS in case a change event is
+missed (e.g. the cache bus is down or disabled).
+"""
+import os
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping, Optional
+from cachetools import TTLCache
+from supabase import create_client
+from dotenv import load_dotenv
+from services.cache_bus import cache_bus
+from services.condition_engine import CompiledCondition, MATCH_ALL
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+PLAN_CACHE_SIZE = int(os.getenv("PIPELINE_PLAN_CACHE_SIZE", "10000"))
+PLAN_TTL_SECONDS = int(os.getenv("PIPELINE_PLAN_TTL_SECONDS", "60"))
+
+EMPTY_CONFIG = MappingProxyType({})
+
+
+def freeze(value):
+    """Recursively turn dicts into read-only mappings and lists into tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+@dataclass(frozen=True)
+class PlanBlock:
+    block_id: str
+    type: str
+    title: str
+    position: int
+    config: Mapping
+
+
+@dataclass(frozen=True)
+class PipelinePlan:
+    workspace_id: str
+    blocks: tuple
+    condition: Optional[PlanBlock]  # the condition-email-received block
+    actions: tuple                  # action-* blocks in position order
+    matcher: CompiledCondition = MATCH_ALL  # condition config compiled for evaluation
+
+    @property
+    def condition_config(self) -> Mapping:
+        return self.condition.config if self.condition else EMPTY_CONFIG
+
+
+def compile_plan(workspace_id: str) -> PipelinePlan:
+    """Read a workspace's blocks and configs and compile them into a plan"""
+    blocks_result = supabase.table("pipeline_blocks")\
+        .select("*")\
+        .eq("workspace_id", workspace_id)\
+        .order("position")\
+        .execute()
+
+    configs_result = supabase.table("block_configs")\
+        .select("block_id, config")\
+        .eq("workspace_id", workspace_id)\
+        .execute()
+
+    configs = {row['block_id']: row.get('config') or {} for row in configs_result.data or []}
+
+    blocks = tuple(
+        PlanBlock(
+            block_id=b['block_id'],
+            type=b['type'],
+            title=b.get('title', ''),
+            position=b.get('position', 0),
+            config=freeze(configs.get(b['block_id'], {}))
+        )
+        for b in blocks_result.data or []
+    )
+
+    condition = next((b for b in blocks if b.type == 'condition-email-received'), None)
+
+    return PipelinePlan(
+        workspace_id=workspace_id,
+        blocks=blocks,
+        condition=condition,
+        actions=tuple(b for b in blocks if b.type.startswith('action-')),
+        matcher=CompiledCondition(condition.config) if condition else MATCH_ALL
+    )
+
+
+class PipelinePlanCache:
+    """In-memory plans keyed by workspace_id"""
+
+    def __init__(self, maxsize: int = PLAN_CACHE_SIZE, ttl: int = PLAN_TTL_SECONDS):
+        self._lock = threading.Lock()
+        self._plans = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, workspace_id: str) -> PipelinePlan:
+        with self._lock:
+            plan = self._plans.get(workspace_id)
+        if plan is None:
+            plan = self.rebuild(workspace_id)
+        return plan
+
+    def rebuild(self, workspace_id: str) -> PipelinePlan:
+        plan = compile_plan(workspace_id)
+        with self._lock:
+            self._plans[workspace_id] = plan
+        print(f"Compiled pipeline plan for workspace {workspace_id}: {len(plan.blocks)} blocks")
+        return plan
+
+    def refresh(self, workspace_id: str):
+        """Rebuild a plan only if it is currently cached"""
+        with self._lock:
+            cached = workspace_id in self._plans
+        if cached:
+            self.rebuild(workspace_id)
+
+    def invalidate(self, workspace_id: str):
+        with self._lock:
+            self._plans.pop(workspace_id, None)
+
+
+# Singleton instance
+pipeline_plans = PipelinePlanCache()
+
+
+def _on_pipeline_change(row: dict):
+    if row.get('workspace_id'):
+        pipeline_plans.invalidate(row['workspace_id'])
+
+
+cache_bus.subscribe("block_configs", _on_pipeline_change)
+cache_bus.subscribe("pipeline_blocks", _on_pipeline_change)
@@ -0,0 +1,38 @@
+"""
+Parsing of combined decide-and-reply responses.
+Kept free of SDK and database imports so it can be tested on its own.
+"""
+import re
+from dataclasses import dataclass
+
+DECISION_LINE = re.compile(r"^\s*DECISION:\s*(YES|NO)\b\s*[-:]?\s*(.*)$", re.IGNORECASE | re.MULTILINE)
+REPLY_MARKER = re.compile(r"^\s*REPLY:\s*", re.IGNORECASE | re.MULTILINE)
+
+
+@dataclass(frozen=True)
+class ReplyDecision:
+    """Parsed result of a combined decide-and-reply call"""
+    should_reply: bool
+    reason: str
+    reply: str = ""
+
+
+def parse_reply_decision(text: str) -> ReplyDecision:
+    """
+    Parse 'DECISION: YES/NO - reason' followed by 'REPLY: ...'.
+    Anything unparseable is treated as NO so we never send a malformed reply.
+    """
+    match = DECISION_LINE.search(text or "")
+    if not match:
+        return ReplyDecision(False, f"NO - unparseable decision: {(text or '')[:80]!r}")
+
+    verdict = match.group(1).upper()
+    reason = f"{verdict} - {match.group(2).strip()}".rstrip(" -")
+    if verdict != "YES":
+        return ReplyDecision(False, reason)
+
+    marker = REPLY_MARKER.search(text, match.end())
+    reply = text[marker.end():].strip() if marker else ""
+    if not reply:
+        return ReplyDecision(False, "NO - decision was YES but no reply text was returned")
+    return ReplyDecision(True, reason, reply)
@@ -0,0 +1,189 @@
+"""
+Learned sender reputation for reply decisions.
+Keeps exponentially decayed YES/NO counts per workspace for each sender
+address and sender domain. Senders with a consistent NO history are
+skipped without an LLM call, except for a small random sample that is
+re-checked so a sender can recover. An address with any YES history is
+never skipped, and domain history alone needs far more evidence
+(DOMAIN_SKIP_THRESHOLD) so one noisy address can't silence its colleagues.
+
+Persisted in the sender_reputation table (unique on workspace_id,
+sender_key). Each decision is applied in the database by the
+record_sender_decision RPC, which decays and increments the stored
+scores in one statement, so concurrent web and Celery processes never
+overwrite each other. Tables are read into memory for the hot path. Each
+change is applied to them through the cache bus, and they expire after
+TABLE_TTL_SECONDS.
+"""
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from cachetools import TTLCache
+from supabase import create_client
+from dotenv import load_dotenv
+from services.cache_bus import cache_bus
+from services.mailbox_identity import parse_address
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+HALF_LIFE_SECONDS = float(os.getenv("SENDER_REPUTATION_HALF_LIFE_DAYS", "14")) * 86400
+SKIP_THRESHOLD = float(os.getenv("SENDER_REPUTATION_SKIP_THRESHOLD", "5"))
+DOMAIN_SKIP_THRESHOLD = float(os.getenv("SENDER_REPUTATION_DOMAIN_SKIP_THRESHOLD", "20"))
+TABLE_TTL_SECONDS = int(os.getenv("SENDER_REPUTATION_TABLE_TTL", "300"))
+TABLE_CACHE_SIZE = int(os.getenv("SENDER_REPUTATION_TABLE_CACHE_SIZE", "1000"))
+# Share of would-be-skipped emails that still go to the LLM as a re-check
+SAMPLE_RATE = float(os.getenv("SENDER_REPUTATION_SAMPLE_RATE", "0.1"))
+
+# Domain-level reputation is meaningless for shared mailbox providers
+FREEMAIL_DOMAINS = {
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com",
+    "msn.com", "yahoo.com", "icloud.com", "me.com", "aol.com", "proton.me",
+    "protonmail.com", "gmx.com", "mail.com",
+}
+
+
+@dataclass
+class Reputation:
+    no_score: float = 0.0
+    yes_score: float = 0.0
+    updated_at: float = 0.0
+
+    def decay(self, now: float):
+        if self.updated_at:
+            factor = 0.5 ** ((now - self.updated_at) / HALF_LIFE_SECONDS)
+            self.no_score *= factor
+            self.yes_score *= factor
+        self.updated_at = now
+
+
+def _from_row(row: dict) -> Reputation:
+    updated_at = datetime.fromisoformat(row['updated_at'].replace('Z', '+00:00')).timestamp()
+    return Reputation(row['no_score'], row['yes_score'], updated_at)
+
+
+def sender_keys(sender: str) -> list:
+    """['address:bob@acme.com', 'domain:acme.com'] (no domain key for freemail)"""
+    address = parse_address(sender)
+    if not address:
+        return []
+    keys = [f"address:{address}"]
+    domain = address.rpartition("@")[2]
+    if domain and domain not in FREEMAIL_DOMAINS:
+        keys.append(f"domain:{domain}")
+    return keys
+
+
+class SenderReputation:
+    """workspace_id -> {sender_key -> Reputation}"""
+
+    def __init__(self, ttl: int = TABLE_TTL_SECONDS, maxsize: int = TABLE_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._tables = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _table(self, workspace_id: str) -> dict:
+        with self._lock:
+            table = self._tables.get(workspace_id)
+        if table is not None:
+            return table
+
+        result = supabase.table("sender_reputation")\
+            .select("sender_key, no_score, yes_score, updated_at")\
+            .eq("workspace_id", workspace_id)\
+            .execute()
+
+        table = {row['sender_key']: _from_row(row) for row in result.data or []}
+
+        with self._lock:
+            return self._tables.setdefault(workspace_id, table)
+
+    def apply(self, workspace_id: str, sender_key: str, reputation: Reputation):
+        """Take a stored row as the current state (if the workspace is cached)"""
+        with self._lock:
+            table = self._tables.get(workspace_id)
+            if table is not None:
+                table[sender_key] = reputation
+
+    def _scores(self, table: dict, key: str, now: float):
+        reputation = table.get(key)
+        if reputation is None:
+            return None
+        with self._lock:
+            reputation.decay(now)
+            return reputation.no_score, reputation.yes_score
+
+    def should_skip(self, workspace_id: str, sender: str) -> Optional[str]:
+        """Returns a 'NO - reason' when the sender's history says skip, else None"""
+        table = self._table(workspace_id)
+        now = time.time()
+        keys = sender_keys(sender)
+        if not keys:
+            return None
+
+        address = self._scores(table, keys[0], now)
+        if address and address[1] >= 1:
+            # We have replied to this address before
+            return None
+
+        skip_key = None
+        if address and address[0] >= SKIP_THRESHOLD:
+            skip_key = keys[0]
+        elif len(keys) > 1:
+            domain = self._scores(table, keys[1], now)
+            if domain and domain[0] >= DOMAIN_SKIP_THRESHOLD and domain[1] < 1:
+                skip_key = keys[1]
+
+        if skip_key is None:
+            return None
+        if random.random() < SAMPLE_RATE:
+            print(f"Re-checking {skip_key} despite NO history")
+            return None
+        return f"NO - consistently skipped sender ({skip_key})"
+
+    def reply_rate(self, workspace_id: str, sender: str) -> Optional[float]:
+        """Decayed share of YES decisions for the sender address, None if unknown"""
+        keys = sender_keys(sender)
+        reputation = self._table(workspace_id).get(keys[0]) if keys else None
+        if reputation is None:
+            return None
+        total = reputation.no_score + reputation.yes_score
+        return reputation.yes_score / total if total else None
+
+    def record(self, workspace_id: str, sender: str, replied: bool):
+        """Record the outcome of an LLM reply decision"""
+        for key in sender_keys(sender):
+            try:
+                result = supabase.rpc("record_sender_decision", {
+                    "p_workspace_id": workspace_id,
+                    "p_sender_key": key,
+                    "p_replied": replied,
+                    "p_half_life_seconds": HALF_LIFE_SECONDS
+                }).execute()
+            except Exception as e:
+                print(f"Could not persist sender reputation: {e}")
+                continue
+            # The RPC returns the row as stored, including other processes' decisions
+            rows = result.data if isinstance(result.data, list) else [result.data]
+            for row in rows:
+                if row:
+                    self.apply(workspace_id, key, _from_row(row))
+
+
+# Singleton instance
+sender_reputation = SenderReputation()
+
+
+def _on_reputation_change(row: dict):
+    if row.get('workspace_id') and row.get('sender_key') and row.get('updated_at'):
+        sender_reputation.apply(row['workspace_id'], row['sender_key'], _from_row(row))
+
+
+cache_bus.subscribe("sender_reputation", _on_reputation_change, events=("INSERT", "UPDATE"))
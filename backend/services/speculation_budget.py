@@ -0,0 +1,51 @@
+"""
+Per-workspace budget for speculative reply generation.
+A speculative reply is started while the should-reply decision is still
+running. When the decision comes back YES the call was needed anyway and
+is refunded; when it is NO the call is wasted spend. The budget caps how
+many speculative calls a workspace may have charged in a rolling window,
+which bounds the waste.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+# Speculative calls a workspace may spend per window (refunded on YES)
+BUDGET = int(os.getenv("SPECULATIVE_REPLY_BUDGET", "20"))
+WINDOW_SECONDS = float(os.getenv("SPECULATIVE_REPLY_WINDOW_SECONDS", "3600"))
+# Only speculate for senders we reply to at least this often
+MIN_REPLY_RATE = float(os.getenv("SPECULATIVE_REPLY_MIN_RATE", "0.6"))
+
+
+class SpeculationBudget:
+    """workspace_id -> timestamps of charged speculative calls"""
+
+    def __init__(self, budget: int = BUDGET, window: float = WINDOW_SECONDS):
+        self.budget = budget
+        self.window = window
+        self._lock = threading.Lock()
+        self._charges = {}
+
+    def try_spend(self, workspace_id: str) -> bool:
+        """Charge one speculative call; False when the workspace is out of budget"""
+        now = time.monotonic()
+        with self._lock:
+            charges = self._charges.setdefault(workspace_id, deque())
+            while charges and charges[0] <= now - self.window:
+                charges.popleft()
+            if len(charges) >= self.budget:
+                return False
+            charges.append(now)
+            return True
+
+    def refund(self, workspace_id: str):
+        """The speculation turned out to be needed, give the charge back"""
+        with self._lock:
+            charges = self._charges.get(workspace_id)
+            if charges:
+                charges.pop()
+
+
+# Singleton instance
+speculation_budget = SpeculationBudget()
@@ -0,0 +1,132 @@
+"""
+Background renewal of Gmail watches and Outlook Graph subscriptions.
+Gmail watches expire after ~7 days, Graph message subscriptions after at
+most ~3. Each pass reads the expirations from gmail_watches and
+outlook_watches and renews whatever is due, in small rate-limited batches.
+
+A mailbox is due RENEW_BEFORE ahead of its expiry plus a stable per-mailbox
+jitter, so mailboxes launched together are renewed spread out over
+RENEWAL_JITTER instead of all at the same moment.
+
+Renewals must run on one node: every Outlook renewal also queues a delta
+sync, so running it twice duplicates work. With the shared tier
+(DEDUPE_REDIS_URL) each pass takes a cluster-wide lease first. Without it
+every node renews, which is right for a single node; a multi-node
+deployment sets WATCH_RENEWAL_ENABLED=false on all nodes but one.
+"""
+import os
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+from supabase import create_client
+from dotenv import load_dotenv
+from services.leases import leases
+
+load_dotenv()
+
+supabase = create_client(
+    os.getenv("SUPABASE_URL"),
+    os.getenv("SUPABASE_KEY")
+)
+
+# Opt this node out of renewal (multi-node deployments without the shared tier)
+ENABLED = os.getenv("WATCH_RENEWAL_ENABLED", "true").lower() == "true"
+INTERVAL_SECONDS = int(os.getenv("WATCH_RENEWAL_INTERVAL", "300"))
+LEASE_NAME = "watch-renewal"
+GMAIL_RENEW_BEFORE = timedelta(hours=float(os.getenv("GMAIL_WATCH_RENEW_BEFORE_HOURS", "48")))
+OUTLOOK_RENEW_BEFORE = timedelta(hours=float(os.getenv("OUTLOOK_SUBSCRIPTION_RENEW_BEFORE_HOURS", "24")))
+RENEWAL_JITTER = timedelta(hours=float(os.getenv("WATCH_RENEWAL_JITTER_HOURS", "6")))
+BATCH_SIZE = int(os.getenv("WATCH_RENEWAL_BATCH_SIZE", "10"))
+# Provider calls per second across all batches
+RATE_PER_SECOND = float(os.getenv("WATCH_RENEWAL_RATE", "5"))
+
+
+def _parse_time(value: str) -> datetime:
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _jitter(key: str) -> timedelta:
+    """Stable offset in [0, RENEWAL_JITTER) so a mailbox keeps its slot"""
+    fraction = int(hashlib.md5(key.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return RENEWAL_JITTER * fraction
+
+
+class WatchRenewalScheduler:
+    """Renews Gmail watches and Outlook subscriptions ahead of expiry"""
+
+    def _due(self, table: str, key_column: str, renew_before: timedelta) -> dict:
+        """{key: user_id} for watches whose jittered renewal time has passed"""
+        now = datetime.now(timezone.utc)
+        horizon = now + renew_before + RENEWAL_JITTER
+        result = supabase.table(table)\
+            .select(f"user_id, {key_column}, expiration")\
+            .lt("expiration", horizon.isoformat())\
+            .execute()
+
+        due = {}
+        for row in result.data or []:
+            key = row.get(key_column)
+            if not key or not row.get('expiration') or key in due:
+                continue
+            if now >= _parse_time(row['expiration']) - renew_before - _jitter(key):
+                due[key] = row['user_id']
+        return due
+
+    async def _renew_gmail(self, user_id: str):
+        from handlers.gmail_webhook_handler import renew_gmail_watch
+        await asyncio.get_running_loop().run_in_executor(None, renew_gmail_watch, user_id)
+
+    async def _renew_outlook(self, subscription_id: str, user_id: str):
+        from handlers.outlook_webhook_handler import renew_outlook_subscription
+        await renew_outlook_subscription(user_id, subscription_id)
+
+    async def _run_batches(self, label: str, jobs: list):
+        for start in range(0, len(jobs), BATCH_SIZE):
+            batch = jobs[start:start + BATCH_SIZE]
+            results = await asyncio.gather(*(job() for _, job in batch), return_exceptions=True)
+            for (key, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    print(f"{label} renewal failed for {key}: {result}")
+            if start + BATCH_SIZE < len(jobs):
+                await asyncio.sleep(len(batch) / RATE_PER_SECOND)
+
+    async def renew_due(self):
+        """One pass: renew every Gmail watch and Outlook subscription that is due"""
+        # Gmail watches are per mailbox: one renewal covers all of a user's rows
+        gmail = self._due("gmail_watches", "user_id", GMAIL_RENEW_BEFORE)
+        outlook = self._due("outlook_watches", "subscription_id", OUTLOOK_RENEW_BEFORE)
+
+        if gmail or outlook:
+            print(f"Renewing {len(gmail)} Gmail watch(es) and {len(outlook)} Outlook subscription(s)")
+
+        await self._run_batches("Gmail watch", [
+            (user_id, lambda user_id=user_id: self._renew_gmail(user_id))
+            for user_id in gmail
+        ])
+        await self._run_batches("Outlook subscription", [
+            (subscription_id, lambda s=subscription_id, u=user_id: self._renew_outlook(s, u))
+            for subscription_id, user_id in outlook.items()
+        ])
+
+    def _owns_renewal(self, interval: int) -> bool:
+        if not leases.available:
+            return True
+        # The holder keeps extending the lease; it lapses two intervals after the holder stops
+        return leases.try_acquire(LEASE_NAME, interval * 2)
+
+    async def run(self, interval: int = INTERVAL_SECONDS):
+        if not ENABLED:
+            print("Watch renewal disabled on this node (WATCH_RENEWAL_ENABLED=false)")
+            return
+        while True:
+            try:
+                if self._owns_renewal(interval):
+                    await self.renew_due()
+            except Exception as e:
+                print(f"Watch renewal pass failed: {e}")
+            await asyncio.sleep(interval)
+
+
+# Singleton instance
+watch_renewal = WatchRenewalScheduler()
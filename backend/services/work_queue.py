@@ -0,0 +1,83 @@
+"""
+Supervised in-process work queue for webhook processing.
+Webhook endpoints enqueue a job and acknowledge immediately; a fixed pool
+of worker tasks runs the jobs with bounded concurrency. On shutdown the
+queue is drained (up to a timeout) before the workers are cancelled.
+"""
+import os
+import asyncio
+import traceback
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WORKERS = int(os.getenv("WORK_QUEUE_WORKERS", "8"))
+MAX_PENDING = int(os.getenv("WORK_QUEUE_MAX_PENDING", "1000"))
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("WORK_QUEUE_DRAIN_TIMEOUT", "30"))
+
+
+class WorkQueue:
+    """Bounded asyncio queue with a fixed pool of worker tasks"""
+
+    def __init__(self, workers: int = WORKERS, max_pending: int = MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._tasks = [
+            asyncio.create_task(self._worker(n), name=f"work-queue-{n}")
+            for n in range(self.workers)
+        ]
+        print(f"Work queue started with {self.workers} workers")
+
+    def submit(self, fn, *args) -> bool:
+        """
+        Enqueue fn(*args) (a coroutine function).
+        Returns False if the queue is not running or full, so the caller can
+        ask the sender to retry instead of dropping the job.
+        """
+        if not self.running:
+            return False
+        try:
+            self._queue.put_nowait((fn, args))
+            return True
+        except asyncio.QueueFull:
+            print(f"Work queue full ({self.max_pending} pending), rejecting {fn.__name__}")
+            return False
+
+    async def _worker(self, n: int):
+        while True:
+            fn, args = await self._queue.get()
+            try:
+                await fn(*args)
+            except Exception as e:
+                print(f"Work queue job {fn.__name__} failed: {e}")
+                traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT_SECONDS):
+        """Wait for pending jobs to finish, then stop the workers"""
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Work queue drain timed out with {self._queue.qsize()} jobs pending")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+# Singleton instance
+work_queue = WorkQueue()
@@ -0,0 +1,28 @@
+from services.condition_engine import CompiledCondition
+
+
+def rejection(config, subject, sender="Jane <jane@example.com>"):
+    return CompiledCondition(config).rejection_reason(sender, subject, False)
+
+
+def test_backreferences_keep_their_own_group_numbers():
+    config = {"subjectRegex": ["^invoice (\\d+)$", "(b)\\1"]}
+    assert rejection(config, "bb") is None
+    assert rejection(config, "invoice 42") is None
+    assert rejection(config, "ba") is not None
+
+
+def test_inline_flags_are_valid_in_any_position():
+    config = {"subjectRegex": ["^report", "(?i)urgent"]}
+    assert rejection(config, "URGENT: server down") is None
+    assert rejection(config, "weekly report") is not None
+
+
+def test_invalid_pattern_is_rejected_without_dropping_the_rest(capsys):
+    config = {"subjectRegex": ["(unclosed", "urgent"]}
+    assert rejection(config, "urgent") is None
+    assert "Rejected invalid subjectRegex '(unclosed'" in capsys.readouterr().out
+
+
+def test_only_invalid_patterns_match_nothing():
+    assert rejection({"subjectRegex": ["(unclosed"]}, "anything") is not None
@@ -0,0 +1,28 @@
+from services.email_prefilter import classify, relevant_headers
+
+
+def test_no_reply_senders():
+    assert classify("No Reply <no-reply@example.com>") == "NO - no-reply sender"
+    assert classify("notifications+abc@github.com") == "NO - no-reply sender"
+    assert classify("Jane <jane@example.com>") is None
+
+
+def test_auto_submitted_unless_no():
+    assert classify("jane@example.com", {"auto-submitted": "auto-replied"}) == "NO - Auto-Submitted: auto-replied"
+    assert classify("jane@example.com", {"auto-submitted": "no"}) is None
+
+
+def test_list_and_bulk_headers():
+    assert classify("jane@example.com", {"precedence": "Bulk"}) == "NO - bulk/list precedence"
+    assert classify("jane@example.com", {"list-id": "<dev.example.com>"}) is not None
+    assert classify("jane@example.com", {"return-path": "<>"}) == "NO - bounce notification"
+
+
+def test_gmail_category_labels():
+    assert classify("jane@example.com", label_ids=["INBOX", "CATEGORY_UPDATES"]) == "NO - Gmail CATEGORY_UPDATES"
+    assert classify("jane@example.com", label_ids=["INBOX", "CATEGORY_PERSONAL"]) is None
+
+
+def test_relevant_headers_keeps_only_known_names():
+    headers = [{"name": "List-Unsubscribe", "value": "<mailto:x@y>"}, {"name": "Subject", "value": "hi"}]
+    assert relevant_headers(headers) == {"list-unsubscribe": "<mailto:x@y>"}
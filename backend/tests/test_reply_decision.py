@@ -0,0 +1,31 @@
+from services.reply_decision import parse_reply_decision
+
+
+def test_yes_with_reply_text():
+    decision = parse_reply_decision("DECISION: YES - direct question\nREPLY:\nHi Jane,\n\nSure thing.")
+    assert decision.should_reply
+    assert decision.reason == "YES - direct question"
+    assert decision.reply == "Hi Jane,\n\nSure thing."
+
+
+def test_no_has_no_reply():
+    decision = parse_reply_decision("DECISION: NO - newsletter")
+    assert not decision.should_reply
+    assert decision.reason == "NO - newsletter"
+    assert decision.reply == ""
+
+
+def test_decision_is_case_insensitive_and_may_follow_preamble():
+    decision = parse_reply_decision("Sure.\ndecision: yes: asks for the report\nreply: Attached.")
+    assert decision.should_reply
+    assert decision.reply == "Attached."
+
+
+def test_yes_without_reply_text_is_no():
+    decision = parse_reply_decision("DECISION: YES - question\nREPLY:")
+    assert not decision.should_reply
+
+
+def test_unparseable_is_no():
+    assert not parse_reply_decision("Sure, here's a reply!").should_reply
+    assert not parse_reply_decision(None).should_reply
@@ -0,0 +1,163 @@
+"""
+Celery worker tier for email processing.
+Enabled with EMAIL_QUEUE_BACKEND=celery on the web nodes. Two queues let
+ingress and LLM-heavy work scale separately:
+
+    celery -A worker worker -Q email --concurrency=8
+    celery -A worker worker -Q llm --concurrency=4
+
+For local testing without Redis set CELERY_TASK_ALWAYS_EAGER=true (with
+CELERY_BROKER_URL=memory://) to run tasks in the calling process. Eager
+tasks are scheduled on the web server's running event loop, are not
+retried, and need no shared dedupe store. Separate worker processes need
+a real broker and DEDUPE_REDIS_URL.
+
+Task coroutines are called with raise_errors=True so failures reach
+Celery and RETRY_OPTIONS take effect. Messages already marked done in the
+shared dedupe store are skipped, so a retry doesn't repeat them.
+"""
+import os
+import asyncio
+from celery import Celery
+from celery.signals import worker_process_init
+from dotenv import load_dotenv
+from services.email_jobs import EAGER
+
+load_dotenv()
+
+BROKER_URL = os.getenv("CELERY_BROKER_URL", os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+# Un-acked jobs are redelivered after this long (must exceed the slowest job)
+VISIBILITY_TIMEOUT_SECONDS = int(os.getenv("CELERY_VISIBILITY_TIMEOUT", "3600"))
+MAX_RETRIES = int(os.getenv("CELERY_MAX_RETRIES", "5"))
+
+celery_app = Celery("backboard", broker=BROKER_URL)
+celery_app.conf.update(
+    task_serializer="json",
+    accept_content=["json"],
+    task_ignore_result=True,
+    task_acks_late=True,
+    task_reject_on_worker_lost=True,
+    worker_prefetch_multiplier=1,
+    worker_concurrency=int(os.getenv("CELERY_WORKER_CONCURRENCY", "4")),
+    broker_transport_options={"visibility_timeout": VISIBILITY_TIMEOUT_SECONDS},
+    task_always_eager=EAGER,
+    task_default_queue="email",
+    task_routes={"worker.reply_email": {"queue": "llm"}},
+)
+
+RETRY_OPTIONS = {
+    "autoretry_for": (Exception,),
+    "retry_backoff": True,
+    "retry_backoff_max": 600,
+    "retry_jitter": True,
+    "max_retries": MAX_RETRIES,
+}
+
+_loop = None
+_eager_tasks = set()
+
+
+def _as_list(workspace_ids) -> list:
+    # Jobs queued before multi-workspace fan-out carry a single workspace_id
+    return [workspace_ids] if isinstance(workspace_ids, str) else workspace_ids
+
+
+def run(coro):
+    """Run a coroutine on this worker process's long-lived event loop"""
+    global _loop
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is not None:
+        # Eager mode inside the web server: its loop can't be re-entered
+        task = running.create_task(coro)
+        _eager_tasks.add(task)
+        task.add_done_callback(_eager_task_done)
+        return None
+
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop.run_until_complete(coro)
+
+
+def _eager_task_done(task):
+    _eager_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Eager email task failed: {task.exception()}")
+
+
+@worker_process_init.connect
+def _init_worker_process(**kwargs):
+    from services import email_jobs
+    from services.cache_bus import cache_bus
+    email_jobs.check_config()
+    cache_bus.start()
+
+
+@celery_app.task(**RETRY_OPTIONS)
+def process_gmail_history(user_id: str, history_id: str):
+    from handlers.gmail_webhook_handler import process_gmail_notification
+    run(process_gmail_notification(user_id, history_id, raise_errors=True))
+
+
+@celery_app.task(**RETRY_OPTIONS)
+def process_gmail_thread(user_id: str, workspace_ids: list, message_ids: list):
+    run(_process_gmail_thread(user_id, _as_list(workspace_ids), message_ids))
+
+
+async def _process_gmail_thread(user_id: str, workspace_ids: list, message_ids: list):
+    from handlers.gmail_webhook_handler import process_new_email
+    from services.dedupe_store import dedupe_store
+    for message_id in message_ids:
+        # On a retry, the messages before the failed one are already done
+        if dedupe_store.is_done('gmail', user_id, message_id):
+            continue
+        await process_new_email(user_id, workspace_ids, message_id, raise_errors=True)
+
+
+@celery_app.task(**RETRY_OPTIONS)
+def process_outlook_batch(notification_data: dict, client_state: str):
+    from handlers.outlook_webhook_handler import process_outlook_notification
+    run(process_outlook_notification(notification_data, client_state, raise_errors=True))
+
+
+@celery_app.task(**RETRY_OPTIONS)
+def process_outlook_message(user_id: str, workspace_ids: list, message_id: str):
+    from handlers.outlook_webhook_handler import process_new_outlook_email
+    from services.dedupe_store import dedupe_store
+    if dedupe_store.is_done('outlook', user_id, message_id):
+        return
+    run(process_new_outlook_email(user_id, _as_list(workspace_ids), message_id, raise_errors=True))
+
+
+@celery_app.task(**RETRY_OPTIONS)
+def sync_outlook_mailbox(user_id: str):
+    from handlers.outlook_webhook_handler import sync_outlook_delta
+    run(sync_outlook_delta(user_id))
+
+
+@celery_app.task(**RETRY_OPTIONS)
+def reply_email(workspace_id: str, user_id: str, block_id: str, trigger_data: dict):
+    run(_reply_email(workspace_id, user_id, block_id, trigger_data))
+
+
+async def _reply_email(workspace_id: str, user_id: str, block_id: str, trigger_data: dict):
+    from blocks.action_reply_email import execute_reply_email
+    from services.pipeline_plan import pipeline_plans
+
+    plan = pipeline_plans.get(workspace_id)
+    block = next((b for b in plan.actions if b.block_id == block_id), None)
+    if block is None:
+        print(f"Block {block_id} no longer in workspace {workspace_id}, skipping reply")
+        return
+
+    result = await execute_reply_email(
+        workspace_id=workspace_id,
+        user_id=user_id,
+        trigger_data=trigger_data,
+        config=block.config
+    )
+    if result.get('status') == 'error':
+        raise Exception(result.get('error'))
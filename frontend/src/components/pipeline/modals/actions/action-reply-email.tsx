@@ -2,7 +2,7 @@
 'use client';
 import React, { useState, useEffect } from 'react';
 import { createPortal } from 'react-dom';
-import { X, Reply, Sparkles, FileEdit, Send, AlertTriangle } from 'lucide-react';
+import { X, Reply, Sparkles, FileEdit, Send, AlertTriangle, Zap, FastForward } from 'lucide-react';
 import { BlockData } from '../../../../../types/pipeline';
 import { createClient } from '@/lib/supabase/client';
 
@@ -23,6 +23,9 @@ export function ActionReplyEmailModal({
 }: ActionReplyEmailModalProps) {
   const [customInstructions, setCustomInstructions] = useState('');
   const [draftMode, setDraftMode] = useState(true); // Default: enabled (safer)
+  const [replyMode, setReplyMode] = useState<'standard' | 'combined'>('standard');
+  const [speculativeReply, setSpeculativeReply] = useState(false);
+  const [extraConfig, setExtraConfig] = useState<Record<string, unknown>>({}); // keys this modal doesn't edit
   const [showWarning, setShowWarning] = useState(false);
   const [loading, setLoading] = useState(true);
   const [mounted, setMounted] = useState(false);
@@ -69,8 +72,12 @@ export function ActionReplyEmailModal({
         console.log('Setting custom instructions:', data[0].config.customInstructions);
         console.log('Setting draft mode:', data[0].config.draftMode);
         
-        setCustomInstructions(data[0].config.customInstructions || '');
-        setDraftMode(data[0].config.draftMode !== undefined ? data[0].config.draftMode : true);
+        const { customInstructions, draftMode, replyMode, speculativeReply, ...rest } = data[0].config;
+        setCustomInstructions(customInstructions || '');
+        setDraftMode(draftMode !== undefined ? draftMode : true);
+        setReplyMode(replyMode === 'combined' ? 'combined' : 'standard');
+        setSpeculativeReply(speculativeReply === true);
+        setExtraConfig(rest);
       } else {
         console.log('No config found, using defaults');
         console.log('   Data returned:', data);
@@ -106,6 +113,7 @@ export function ActionReplyEmailModal({
     console.log('   Workspace ID:', workspaceId);
     console.log('   Custom Instructions:', customInstructions);
     console.log('   Draft Mode:', draftMode);
+    console.log('   Reply Mode:', replyMode);
     
     try {
       // STEP 1: Delete ALL existing configs for this block (keep table clean)
@@ -129,8 +137,11 @@ export function ActionReplyEmailModal({
         workspace_id: workspaceId,
         block_id: blockData.id,
         config: {
+          ...extraConfig,
           customInstructions,
-          draftMode
+          draftMode,
+          replyMode,
+          speculativeReply
         }
       };
       
@@ -263,6 +274,52 @@ export function ActionReplyEmailModal({
                 )}
               </div>
 
+              {/* Fast Mode Toggle */}
+              <label className="flex items-center justify-between cursor-pointer group">
+                <div className="flex items-center gap-3">
+                  <Zap size={20} className={replyMode === 'combined' ? 'text-cyan-600' : 'text-slate-400'} />
+                  <div>
+                    <div className="text-sm font-semibold text-slate-900">Fast Mode</div>
+                    <div className="text-xs text-slate-500">
+                      Decide and write the reply in a single AI call
+                    </div>
+                  </div>
+                </div>
+                <div className="relative">
+                  <input
+                    type="checkbox"
+                    checked={replyMode === 'combined'}
+                    onChange={() => setReplyMode(replyMode === 'combined' ? 'standard' : 'combined')}
+                    className="sr-only peer"
+                  />
+                  <div className="w-11 h-6 bg-slate-200 peer-focus:outline-none peer-focus:ring-4 peer-focus:ring-cyan-300 rounded-full peer peer-checked:after:translate-x-full peer-checked:after:border-white after:content-[''] after:absolute after:top-[2px] after:left-[2px] after:bg-white after:border-slate-300 after:border after:rounded-full after:h-5 after:w-5 after:transition-all peer-checked:bg-cyan-600"></div>
+                </div>
+              </label>
+
+              {/* Speculative Reply Toggle (standard mode only) */}
+              {replyMode === 'standard' && (
+                <label className="flex items-center justify-between cursor-pointer group">
+                  <div className="flex items-center gap-3">
+                    <FastForward size={20} className={speculativeReply ? 'text-cyan-600' : 'text-slate-400'} />
+                    <div>
+                      <div className="text-sm font-semibold text-slate-900">Speculative Replies</div>
+                      <div className="text-xs text-slate-500">
+                        Start writing replies to frequent contacts before the AI has decided
+                      </div>
+                    </div>
+                  </div>
+                  <div className="relative">
+                    <input
+                      type="checkbox"
+                      checked={speculativeReply}
+                      onChange={() => setSpeculativeReply(!speculativeReply)}
+                      className="sr-only peer"
+                    />
+                    <div className="w-11 h-6 bg-slate-200 peer-focus:outline-none peer-focus:ring-4 peer-focus:ring-cyan-300 rounded-full peer peer-checked:after:translate-x-full peer-checked:after:border-white after:content-[''] after:absolute after:top-[2px] after:left-[2px] after:bg-white after:border-slate-300 after:border after:rounded-full after:h-5 after:w-5 after:transition-all peer-checked:bg-cyan-600"></div>
+                  </div>
+                </label>
+              )}
+
               {/* Backboard Info */}
               <div className="p-4 bg-gradient-to-br from-blue-50 to-cyan-50 border border-blue-200 rounded-xl">
                 <div className="flex gap-2">
@@ -24,6 +24,10 @@ export function ConditionEmailReceivedModal({
     senderEmail: '',
     subjectContains: '',
     hasAttachment: false,
+    senderAllowList: '',
+    senderDenyList: '',
+    subjectKeywords: '',
+    subjectRegex: '',
   });
   const [loading, setLoading] = useState(true);
   const [mounted, setMounted] = useState(false);
@@ -38,6 +42,10 @@ export function ConditionEmailReceivedModal({
     }
   }, [isOpen, mounted, blockData.id, workspaceId]);
 
+  // List fields are edited one entry per line and saved as arrays
+  const toLines = (value: unknown) => Array.isArray(value) ? value.join('\n') : (typeof value === 'string' ? value : '');
+  const toList = (value: string) => value.split(/[\n,]/).map((v) => v.trim()).filter(Boolean);
+
   const loadConfig = async () => {
     setLoading(false);
     
@@ -59,6 +67,10 @@ export function ConditionEmailReceivedModal({
             senderEmail: data.config.senderEmail || '',
             subjectContains: data.config.subjectContains || '',
             hasAttachment: data.config.hasAttachment || false,
+            senderAllowList: toLines(data.config.senderAllowList),
+            senderDenyList: toLines(data.config.senderDenyList),
+            subjectKeywords: toLines(data.config.subjectKeywords),
+            subjectRegex: toLines(data.config.subjectRegex),
           });
         }
       } else {
@@ -98,7 +110,13 @@ export function ConditionEmailReceivedModal({
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           workspace_id: workspaceId,
-          config: settings
+          config: {
+            ...settings,
+            senderAllowList: toList(settings.senderAllowList),
+            senderDenyList: toList(settings.senderDenyList),
+            subjectKeywords: toList(settings.subjectKeywords),
+            subjectRegex: settings.subjectRegex.split('\n').map((v) => v.trim()).filter(Boolean),
+          }
         })
       });
       
@@ -121,6 +139,18 @@ export function ConditionEmailReceivedModal({
       if (settings.hasAttachment) {
         filters.push('with attachment');
       }
+      if (toList(settings.senderAllowList).length) {
+        filters.push(`${toList(settings.senderAllowList).length} allowed senders`);
+      }
+      if (toList(settings.senderDenyList).length) {
+        filters.push(`${toList(settings.senderDenyList).length} blocked senders`);
+      }
+      if (toList(settings.subjectKeywords).length) {
+        filters.push(`${toList(settings.subjectKeywords).length} subject keywords`);
+      }
+      if (settings.subjectRegex.trim()) {
+        filters.push('subject pattern');
+      }
       
       if (filters.length > 0) {
         description = filters.join(', ');
@@ -225,6 +255,72 @@ export function ConditionEmailReceivedModal({
                 </p>
               </div>
 
+              {/* Sender Allow / Deny Lists */}
+              <div>
+                <label className="block text-sm font-semibold text-slate-700 mb-2">
+                  Allowed Senders
+                </label>
+                <textarea
+                  value={settings.senderAllowList}
+                  onChange={(e) => setSettings({ ...settings, senderAllowList: e.target.value })}
+                  placeholder={'jane@acme.com\nacme.com'}
+                  rows={3}
+                  className="w-full px-4 py-3 border border-slate-300 rounded-xl focus:ring-2 focus:ring-blue-500 focus:border-transparent outline-none transition-all text-sm font-mono"
+                />
+                <p className="text-xs text-slate-500 mt-2">
+                  One address or domain per line. Domains include their subdomains. Leave empty to allow anyone
+                </p>
+              </div>
+
+              <div>
+                <label className="block text-sm font-semibold text-slate-700 mb-2">
+                  Blocked Senders
+                </label>
+                <textarea
+                  value={settings.senderDenyList}
+                  onChange={(e) => setSettings({ ...settings, senderDenyList: e.target.value })}
+                  placeholder={'noreply@vendor.com\nmarketing.example.com'}
+                  rows={3}
+                  className="w-full px-4 py-3 border border-slate-300 rounded-xl focus:ring-2 focus:ring-blue-500 focus:border-transparent outline-none transition-all text-sm font-mono"
+                />
+                <p className="text-xs text-slate-500 mt-2">
+                  Emails from these addresses or domains never trigger this block
+                </p>
+              </div>
+
+              {/* Subject Keywords / Patterns */}
+              <div>
+                <label className="block text-sm font-semibold text-slate-700 mb-2">
+                  Subject Keywords
+                </label>
+                <textarea
+                  value={settings.subjectKeywords}
+                  onChange={(e) => setSettings({ ...settings, subjectKeywords: e.target.value })}
+                  placeholder={'invoice\norder'}
+                  rows={3}
+                  className="w-full px-4 py-3 border border-slate-300 rounded-xl focus:ring-2 focus:ring-blue-500 focus:border-transparent outline-none transition-all text-sm font-mono"
+                />
+                <p className="text-xs text-slate-500 mt-2">
+                  The subject must contain at least one of these (case-insensitive)
+                </p>
+              </div>
+
+              <div>
+                <label className="block text-sm font-semibold text-slate-700 mb-2">
+                  Subject Patterns (regex)
+                </label>
+                <textarea
+                  value={settings.subjectRegex}
+                  onChange={(e) => setSettings({ ...settings, subjectRegex: e.target.value })}
+                  placeholder={'^\\[Ticket #\\d+\\]'}
+                  rows={2}
+                  className="w-full px-4 py-3 border border-slate-300 rounded-xl focus:ring-2 focus:ring-blue-500 focus:border-transparent outline-none transition-all text-sm font-mono"
+                />
+                <p className="text-xs text-slate-500 mt-2">
+                  One regular expression per line; the subject must match at least one
+                </p>
+              </div>
+
               {/* Has Attachment Toggle */}
               <div>
                 <label className="block text-sm font-semibold text-slate-700 mb-3">